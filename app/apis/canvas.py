@@ -1,6 +1,8 @@
 from email.policy import default
 from enum import Enum
-from fastapi import Body, WebSocket
+import asyncio
+from fastapi import Body, WebSocket, WebSocketDisconnect
+from fastapi.websockets import WebSocketState
 from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field, SerializeAsAny
 from typing import (
@@ -13,15 +15,21 @@ from typing import (
     Union,
     List,
     TypedDict,
+    TYPE_CHECKING,
 )
 from typing_extensions import NotRequired, TypedDict
 import os
 
 from schemas.openai import ChatCompletionResponse, shortuuid
 from workflows.design_expert.workflow import WorkflowResult
-from server_app import app
+from server_app import app, on_startup
 from llama_index.core.workflow.handler import WorkflowHandler
 from schemas.canvas import ChatCompletionRequest, DefaultResponse
+from libs.resources import resources
+from libs.limits import BackendBusy
+from libs.metrics import metrics
+from libs.semantic_cache import CachedCompletion
+from libs.ws_frames import FrameWriter
 
 from workflows.design_expert import (
     DesignExpertWorkflow,
@@ -29,39 +37,77 @@ from workflows.design_expert import (
     DesignExpertWorkflowConfig,
 )
 
-from openinference.instrumentation.llama_index import LlamaIndexInstrumentor
-from langfuse import get_client, Langfuse
-from langfuse._client.span import LangfuseSpan
 import logging
 
+if TYPE_CHECKING:
+    # Observability packages are heavy; they are only imported when enabled
+    from openinference.instrumentation.llama_index import LlamaIndexInstrumentor
+    from langfuse import Langfuse
+    from langfuse._client.span import LangfuseSpan
+
 
 class API_OBSERVABILITY_SERVICE(str, Enum):
     LANGFUSE = "langfuse"
 
 
+completions_cancelled = metrics.counter(
+    "canvas_completions_cancelled_total",
+    "Completions stopped before the end, by reason (disconnect, cancel) and stage",
+)
+cancelled_generated_tokens = metrics.counter(
+    "canvas_cancelled_generated_tokens_total",
+    "Tokens generated for completions that were cancelled afterwards",
+)
+
+
 class CanvasApi:
 
     prefix: str = ""
     ws_completion_endpoint: str = "completion"
 
     get_workflows_endpoint: str = "workflows"
+    reload_config_endpoint: str = "config/reload"
+    limits_endpoint: str = "limits"
     observability: Optional[API_OBSERVABILITY_SERVICE]
     observability_kwargs: Optional[Dict[str, Any]]
 
-    instrumentor: Optional[LlamaIndexInstrumentor] = None
-    langfuse: Optional[Langfuse] = None
+    # Completion deltas are coalesced into frames of up to this many characters,
+    # sent at least every `frame_window` seconds
+    frame_window: float = 0.03
+    frame_max_chars: int = 512
+
+    # Completions running at once on one multiplexed session
+    session_max_requests: int = 8
+
+    instrumentor: Optional["LlamaIndexInstrumentor"] = None
+    langfuse: Optional["Langfuse"] = None
 
     def __init__(
         self,
         prefix: str,
         observability: Optional[API_OBSERVABILITY_SERVICE] = None,
         observability_kwargs: Optional[Dict[str, Any]] = None,
+        frame_window: Optional[float] = None,
+        frame_max_chars: Optional[int] = None,
     ):
         self.prefix = prefix
         self.observability = observability
         self.observability_kwargs = observability_kwargs
+        if frame_window is not None:
+            self.frame_window = frame_window
+        if frame_max_chars is not None:
+            self.frame_max_chars = frame_max_chars
+
+        # Fail at boot, not on the first message, if the workflow `.env` is broken
+        DesignExpertWorkflowConfig.load_env()
+        on_startup(DesignExpertWorkflowConfig.warm_up)
 
         if self.observability and self.observability_kwargs:
+            from openinference.instrumentation.llama_index import (
+                LlamaIndexInstrumentor,
+            )
+            from langfuse import get_client
+
             os.environ["LANGFUSE_PUBLIC_KEY"] = self.observability_kwargs["public_key"]
             os.environ["LANGFUSE_SECRET_KEY"] = self.observability_kwargs["secret_key"]
             os.environ["LANGFUSE_HOST"] = self.observability_kwargs["host"]
@@ -82,19 +128,57 @@ class CanvasApi:
             route=self._start_completion_wrapper,
         )
 
+        app.add_api_route(
+            path=self._merge_path(self.reload_config_endpoint),
+            endpoint=self.reload_config,
+            methods=["POST"],
+        )
+
+        app.add_api_route(
+            path=self._merge_path(self.limits_endpoint),
+            endpoint=self.limits,
+            methods=["GET"],
+        )
+
     def _merge_path(self, opt: str):
         return "/" + self.prefix.strip("/") + "/" + opt.strip("/")
 
+    async def reload_config(self):
+        try:
+            DesignExpertWorkflowConfig.reload_env()
+            await asyncio.to_thread(DesignExpertWorkflowConfig.warm_up)
+            return DefaultResponse(
+                type="confirmation", content="Workflow config reloaded"
+            ).dump()
+        except Exception as error:
+            return JSONResponse(
+                DefaultResponse(type="error", content=str(error)).dump(), 500
+            )
+
+    async def limits(self):
+        """Calls in flight, queue depth and wait times of every backend limiter"""
+        return resources.limiter_stats()
+
     async def _start_completion_wrapper(self, websocket: WebSocket):
+        subprotocol = FrameWriter.negotiate(websocket)
+        writer = FrameWriter(
+            websocket,
+            window=self.frame_window,
+            max_chars=self.frame_max_chars,
+            binary=subprotocol is not None,
+        )
         try:
-            await websocket.accept()
-            if self.instrumentor:
-                await self.start_with_observability(websocket)
+            await websocket.accept(subprotocol=subprotocol)
+            message = await websocket.receive_json()
+            if message.get("type") == "session.start":
+                await self.session(websocket, writer)
             else:
-                await self.completion(websocket)
+                # Legacy single-shot mode: the first message is the request itself
+                await self._run_single(websocket, writer, message)
+        except WebSocketDisconnect:
+            pass
         except Exception as error:
-            response = DefaultResponse(type="error", content=str(error))
-            await websocket.send_json(response.dump())
+            await writer.send(type="error", content=str(error))
         finally:
             if (
                 self.instrumentor
@@ -102,28 +186,144 @@ class CanvasApi:
                 and self.instrumentor.is_instrumented_by_opentelemetry
             ):
                 self.langfuse.flush()
-            await websocket.close()
+            if websocket.client_state != WebSocketState.DISCONNECTED:
+                await websocket.close()
 
-    async def start_with_observability(self, websocket: WebSocket):
+    async def _receive_cancel(self, websocket: WebSocket) -> str:
+        """Wait until the client sends `cancel` or goes away; other messages are ignored"""
+        try:
+            while True:
+                message = await websocket.receive_json()
+                if message.get("type") == "cancel":
+                    return "cancel"
+        except WebSocketDisconnect:
+            return "disconnect"
+        except Exception:
+            return "disconnect"
+
+    async def _run_single(
+        self, websocket: WebSocket, writer: FrameWriter, request: Dict[str, Any]
+    ):
+        """Run one completion while listening for `cancel` or a disconnect"""
+        task = asyncio.ensure_future(self._run_completion(writer, request))
+        receiver = asyncio.ensure_future(self._receive_cancel(websocket))
+        try:
+            await asyncio.wait([task, receiver], return_when=asyncio.FIRST_COMPLETED)
+            if not task.done():
+                task.cancel(msg=receiver.result())
+                await asyncio.gather(task, return_exceptions=True)
+        finally:
+            for pending in (task, receiver):
+                pending.cancel()
+            await asyncio.gather(task, receiver, return_exceptions=True)
+
+    async def session(self, websocket: WebSocket, writer: FrameWriter):
+        """Multiplexed session: many completions over one connection.
+
+        The client sends `{"type": "completion.request", "requestId": ..., "request": {...}}`
+        for every completion; all frames of that completion carry its `requestId`
+        and it ends with its `completion.usage` (or `error`) frame.
+        `{"type": "cancel", "requestId": ...}` stops one completion, `session.end`
+        closes the connection once running completions are done. Completions
+        still running when the client disconnects are cancelled.
+        """
+        tasks: Dict[str, asyncio.Task] = {}
+        cancel_reason = "disconnect"
+        await writer.send(type="session.started", content="Session started")
+
+        try:
+            while True:
+                message = await websocket.receive_json()
+                message_type = message.get("type")
+
+                if message_type == "session.end":
+                    await asyncio.gather(*tasks.values(), return_exceptions=True)
+                    return
+
+                if message_type == "cancel":
+                    task = tasks.get(str(message.get("requestId")))
+                    if task is not None:
+                        task.cancel(msg="cancel")
+                    continue
+
+                if message_type != "completion.request":
+                    await writer.send(
+                        type="error", content=f"Unknown message type `{message_type}`"
+                    )
+                    continue
+
+                request_id = str(message.get("requestId") or shortuuid())
+                request_writer = writer.for_request(request_id)
+                if request_id in tasks:
+                    await request_writer.send(
+                        type="error", content="Request id is already running"
+                    )
+                elif len(tasks) >= self.session_max_requests:
+                    await request_writer.send(
+                        type="error",
+                        content=f"Too many concurrent requests ({self.session_max_requests})",
+                    )
+                else:
+                    task = asyncio.ensure_future(
+                        self._run_completion(request_writer, message.get("request") or {})
+                    )
+                    tasks[request_id] = task
+                    task.add_done_callback(
+                        lambda _, request_id=request_id: tasks.pop(request_id, None)
+                    )
+        finally:
+            for task in tasks.values():
+                task.cancel(msg=cancel_reason)
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    async def _run_completion(self, writer: FrameWriter, request: Dict[str, Any]):
+        # Admission control: completions over the `completions` limit wait in its
+        # queue; once the queue is full (or the wait times out) they are rejected
+        admission = resources.limiter("completions")
+        if admission.saturated:
+            await writer.send(
+                type="completion.queued", payload={"position": admission.queue_depth + 1}
+            )
+        try:
+            await admission.acquire()
+        except BackendBusy as busy:
+            await writer.send(
+                type="error", payload={"error": str(busy), "retryable": True}
+            )
+            return
+
+        try:
+            if self.instrumentor:
+                await self.start_with_observability(writer, request)
+            else:
+                await self.completion(writer, request)
+        finally:
+            admission.release()
+
+    async def start_with_observability(self, writer: FrameWriter, request: Dict[str, Any]):
         assert self.instrumentor
         assert self.langfuse
 
         with self.langfuse.start_as_current_span(
             name=f"workflow-{shortuuid()}"
         ) as trace:
-            await self.completion(websocket, trace)
+            await self.completion(writer, request, trace)
         self.langfuse.flush()
 
     async def completion(
-        self, websocket: WebSocket, trace: Optional[LangfuseSpan] = None
+        self,
+        writer: FrameWriter,
+        request: Dict[str, Any],
+        trace: Optional["LangfuseSpan"] = None,
     ):
+        handler: Optional[WorkflowHandler] = None
+        final_result: Optional[WorkflowResult] = None
+        generated_tokens = 0
+        stage = "setup"
         try:
 
-            request = await websocket.receive_json()
             chatCompletionRequest = ChatCompletionRequest.model_validate(request)
-            await websocket.send_json(
-                DefaultResponse(type="confirmation", content="Starting workflow").dump()
-            )
+            await writer.send(type="confirmation", content="Starting workflow")
 
             workflow_kvargs = DesignExpertWorkflowConfig.init_from_request(
                 request=chatCompletionRequest
@@ -131,22 +331,42 @@ class CanvasApi:
             workflow = DesignExpertWorkflow(**workflow_kvargs)
             # model = chatCompletionrequest.model or ""
 
+            semantic_cache_key = DesignExpertWorkflowConfig.semantic_cache_key(
+                request=chatCompletionRequest
+            )
+            query_embedding: Optional[List[float]] = None
+            if semantic_cache_key:
+                env = DesignExpertWorkflowConfig.get_env()
+                query_embedding = await workflow_kvargs[
+                    "embedding"
+                ].aget_query_embedding(chatCompletionRequest.message)
+                cached_completion = resources.semantic_cache().lookup(
+                    semantic_cache_key,
+                    embedding=query_embedding,
+                    threshold=env.semantic_cache_threshold,
+                    ttl=env.semantic_cache_ttl,
+                )
+                if cached_completion is not None:
+                    await self._replay_cached_completion(
+                        writer, cached_completion, trace
+                    )
+                    return
+
             # we pass it to the workflow
             workflow_run_kvargs = DesignExpertWorkflowConfig.run_from_request(
                 request=chatCompletionRequest
             )
-            handler: WorkflowHandler = workflow.run(**workflow_run_kvargs)
+            workflow_run_kvargs["query_embedding"] = query_embedding
+            handler = workflow.run(**workflow_run_kvargs)
+            stage = "workflow"
 
             # now we handle events coming back from the workflow
             async for event in handler.stream_events():
                 if isinstance(event, ProgressEvent):
-                    await websocket.send_json(
-                        DefaultResponse(
-                            type="event", payload=event.model_dump()
-                        ).model_dump()
-                    )
+                    await writer.send(type="event", payload=event.model_dump())
 
-            final_result: WorkflowResult = await handler
+            final_result = await handler
+            stage = "generation"
 
             accumulated_response = {
                 "full_response": "",
@@ -154,33 +374,26 @@ class CanvasApi:
                 "nodes": final_result.nodes,
                 "generated_tokens": 0,
             }
+            response_chunks: List[str] = []
 
-            for response in final_result.async_response_gen:
+            async for response in final_result.async_response_gen:
+                generated_tokens += 1
                 accumulated_response["generated_tokens"] += 1
                 accumulated_response["full_response"] += str(response.delta)
+                response_chunks.append(str(response.delta))
                 _last_response = response
-                await websocket.send_json(
-                    DefaultResponse(
-                        type="completion.chunk", content=str(response.delta)
-                    ).model_dump()
-                )
+                await writer.chunk(str(response.delta))
 
-            if final_result.nodes:
-                await websocket.send_json(
-                    DefaultResponse(
-                        type="completion.sources",
-                        payload=[node.model_dump() for node in final_result.nodes],
-                    ).model_dump()
-                )
+            sources = [node.model_dump() for node in final_result.nodes]
+            if sources:
+                await writer.send(type="completion.sources", payload=sources)
 
-            await websocket.send_json(
-                DefaultResponse(
-                    type="completion.usage",
-                    payload={
-                        "generated_tokens": accumulated_response["generated_tokens"],
-                        "traceId": trace.trace_id if trace is not None else None,
-                    },
-                ).model_dump()
+            await writer.send(
+                type="completion.usage",
+                payload={
+                    "generated_tokens": accumulated_response["generated_tokens"],
+                    "traceId": trace.trace_id if trace is not None else None,
+                },
             )
 
             if trace:
@@ -188,14 +401,97 @@ class CanvasApi:
                     name="Generation.Complete", output=accumulated_response
                 )
 
+            if semantic_cache_key and query_embedding is not None:
+                resources.semantic_cache().store(
+                    semantic_cache_key,
+                    embedding=query_embedding,
+                    chunks=response_chunks,
+                    sources=sources,
+                )
+
+        except asyncio.CancelledError as cancelled:
+            reason = cancelled.args[0] if cancelled.args else "disconnect"
+            await self._abort_completion(handler, final_result)
+            completions_cancelled.inc(reason=reason, stage=stage)
+            cancelled_generated_tokens.inc(generated_tokens)
+            if trace:
+                trace.create_event(
+                    name="Generation.Cancelled",
+                    output={"reason": reason, "stage": stage, "generated_tokens": generated_tokens},
+                )
+            if reason == "cancel":
+                try:
+                    await writer.send(
+                        type="completion.cancelled",
+                        payload={"generated_tokens": generated_tokens},
+                    )
+                except Exception as error:
+                    print(f"[CanvasApi] Exception: {error}")
+            raise
+
         except Exception as exception:
-            await websocket.send_json(
-                DefaultResponse(
-                    type="error",
-                    payload={
-                        "error": str(exception),
-                        "traceId": trace.id if trace is not None else None,
-                    },
-                ).dump()
+            await self._abort_completion(handler, final_result)
+            await writer.send(
+                type="error",
+                payload={
+                    "error": str(exception),
+                    "traceId": trace.id if trace is not None else None,
+                },
             )
             return
+
+    async def _abort_completion(
+        self,
+        handler: Optional[WorkflowHandler],
+        final_result: Optional[WorkflowResult],
+    ):
+        """Stop the workflow steps (with their retrieval, crawl and embedding calls) and the LLM stream"""
+        if handler is not None and not handler.done():
+            try:
+                await handler.cancel_run()
+            except Exception as error:
+                print(f"[CanvasApi] Exception: {error}")
+        if final_result is not None:
+            try:
+                await final_result.async_response_gen.aclose()
+            except Exception as error:
+                print(f"[CanvasApi] Exception: {error}")
+
+    async def _replay_cached_completion(
+        self,
+        writer: FrameWriter,
+        cached_completion: CachedCompletion,
+        trace: Optional["LangfuseSpan"] = None,
+    ):
+        """Send a completion from the semantic cache as if the workflow had produced it"""
+        await writer.send(
+            type="event",
+            payload=ProgressEvent(
+                description="Answering from cache",
+                payload={"artifactId": shortuuid()},
+            ).model_dump(),
+        )
+
+        for chunk in cached_completion.chunks:
+            await writer.chunk(chunk)
+
+        if cached_completion.sources:
+            await writer.send(
+                type="completion.sources", payload=cached_completion.sources
+            )
+
+        await writer.send(
+            type="completion.usage",
+            payload={
+                "generated_tokens": 0,
+                "cached": True,
+                "similarity": cached_completion.similarity,
+                "traceId": trace.trace_id if trace is not None else None,
+            },
+        )
+
+        if trace:
+            trace.create_event(
+                name="Generation.Cached",
+                output={"similarity": cached_completion.similarity},
+            )
@@ -2,7 +2,7 @@ from enum import Enum
 from fastapi import Body
 from fastapi.responses import JSONResponse, StreamingResponse
 
-from server_app import app
+from server_app import app, on_startup
 from llama_index.core.workflow.handler import WorkflowHandler
 from typing import Annotated, Any, Callable, Optional, Dict
 from schemas.openai import (
@@ -50,6 +50,10 @@ class OpenAIApi:
         self.observability = observability
         self.observability_kwargs = observability_kwargs
 
+        # Fail at boot, not on the first message, if the workflow `.env` is broken
+        DesignRAGWorkflowConfig.load_env()
+        on_startup(DesignRAGWorkflowConfig.warm_up)
+
         if self.observability and self.observability_kwargs:
             self.instrumentor = LlamaIndexInstrumentor(
                 debug=False, **self.observability_kwargs
@@ -92,49 +96,58 @@ class OpenAIApi:
 
         final_result = await handler
 
-        result_index = 0
+        try:
+            result_index = 0
 
-        acc_response: Dict[str, Any] = {"message": "", "metadata": {}}
-        # generating first empty response with role
+            acc_response: Dict[str, Any] = {"message": "", "metadata": {}}
+            # generating first empty response with role
 
-        init_chunk = ChatCompletionChunk(
-            model=model,
-            choices=[
-                ChatCompletionStreamingChoice(
-                    delta=ChoiceDelta(role="assistant"),
-                    index=0,
-                )
-            ],
-        )
-        yield init_chunk
-
-        for chunk in final_result["message"]:
-            result_index += 1
-
-            next_chunk = ChatCompletionChunk(
+            init_chunk = ChatCompletionChunk(
                 model=model,
                 choices=[
                     ChatCompletionStreamingChoice(
-                        delta=ChoiceDelta(content=chunk.delta),
-                        index=result_index,
+                        delta=ChoiceDelta(role="assistant"),
+                        index=0,
                     )
                 ],
             )
-            acc_response["message"] += str(chunk.delta)
-            yield next_chunk
+            yield init_chunk
 
-        # sending final message to show that assistant output has stopped
-        final_chunk = ChatCompletionChunk(
-            model=model,
-            choices=[
-                ChatCompletionStreamingChoice(
-                    delta=ChoiceDelta(), index=(result_index + 1), finish_reason="stop"
+            async for chunk in final_result["message"]:
+                result_index += 1
+
+                next_chunk = ChatCompletionChunk(
+                    model=model,
+                    choices=[
+                        ChatCompletionStreamingChoice(
+                            delta=ChoiceDelta(content=chunk.delta),
+                            index=result_index,
+                        )
+                    ],
                 )
-            ],
-        )
-        if trace:
-            trace.event(name="Workflow.StreamingResponse.Complete", output=acc_response)
-        yield final_chunk
+                acc_response["message"] += str(chunk.delta)
+                yield next_chunk
+
+            # sending final message to show that assistant output has stopped
+            final_chunk = ChatCompletionChunk(
+                model=model,
+                choices=[
+                    ChatCompletionStreamingChoice(
+                        delta=ChoiceDelta(), index=(result_index + 1), finish_reason="stop"
+                    )
+                ],
+            )
+            if trace:
+                trace.event(name="Workflow.StreamingResponse.Complete", output=acc_response)
+            yield final_chunk
+        finally:
+            # Release the LLM stream (and its gemini slot) when the client goes
+            # away or a chunk fails, not when the generator is collected
+            response_gen = (
+                final_result.get("message") if isinstance(final_result, dict) else None
+            )
+            if response_gen is not None and hasattr(response_gen, "aclose"):
+                await response_gen.aclose()
 
     async def generate_streaming_response(self, request: ChatCompletionRequest):
         if self.instrumentor:
@@ -0,0 +1,160 @@
+from functools import lru_cache
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+from llama_index.core.schema import NodeWithScore
+
+
+"""
+==============================================
+    Token-budget context packer
+==============================================
+"""
+
+_SENTENCE = re.compile(r".+?(?:[.!?](?=\s)|\n{2,}|$)", re.DOTALL)
+
+# Reference wrapper and metadata line around each node in the prompt
+NODE_OVERHEAD_TOKENS = 16
+
+
+@lru_cache(maxsize=1)
+def _tokenizer() -> Callable[[str], List[int]]:
+    from llama_index.core.utils import get_tokenizer
+
+    return get_tokenizer()
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Token count of whole node contents and metadata; they repeat across requests"""
+    return len(_tokenizer()(text))
+
+
+def context_token_budget(
+    context_window: Optional[int],
+    max_tokens: Optional[int],
+    cap: int,
+    reserve: int = 2048,
+) -> int:
+    """Tokens available for retrieved context: the model window minus the answer
+    (`max_tokens`) and `reserve` for the prompt template and chat history, at most `cap`"""
+    if not context_window or context_window <= 0:
+        return cap
+    return max(0, min(cap, context_window - (max_tokens or 0) - reserve))
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """Longest prefix of whole sentences within `max_tokens`; words if the first sentence doesn't fit"""
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    tokenize = _tokenizer()
+    end, used = 0, 0
+    for match in _SENTENCE.finditer(text):
+        used += len(tokenize(match.group()))
+        if used > max_tokens:
+            break
+        end = match.end()
+    if end:
+        return text[:end].rstrip()
+
+    words = text.split()
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if len(tokenize(" ".join(words[:middle]))) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return " ".join(words[:low])
+
+
+class PackedContext:
+    nodes: List[NodeWithScore]
+    dropped: List[NodeWithScore]
+    trimmed: List[str]
+    tokens: int
+    budget: int
+
+    def __init__(
+        self,
+        nodes: List[NodeWithScore],
+        dropped: List[NodeWithScore],
+        trimmed: List[str],
+        tokens: int,
+        budget: int,
+    ):
+        self.nodes = nodes
+        self.dropped = dropped
+        self.trimmed = trimmed
+        self.tokens = tokens
+        self.budget = budget
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "kept": len(self.nodes),
+            "dropped": [node.node.node_id for node in self.dropped],
+            "trimmed": self.trimmed,
+            "tokens": self.tokens,
+            "budget": self.budget,
+        }
+
+
+def pack_nodes(
+    nodes: List[NodeWithScore],
+    budget: int,
+    max_node_tokens: Optional[int] = None,
+    min_node_tokens: int = 64,
+) -> PackedContext:
+    """Fit nodes into `budget` tokens, best scored first, keeping their input order.
+
+    Nodes longer than `max_node_tokens`, or than what is left of the budget, are
+    trimmed at a sentence boundary (trimmed copies, the originals are untouched);
+    nodes that would get less than `min_node_tokens` are dropped.
+    """
+    ranked = sorted(
+        range(len(nodes)),
+        key=lambda idx: (
+            nodes[idx].score if nodes[idx].score is not None else float("-inf")
+        ),
+        reverse=True,
+    )
+
+    kept: Dict[int, NodeWithScore] = {}
+    dropped: List[NodeWithScore] = []
+    trimmed: List[str] = []
+    used = 0
+
+    for idx in ranked:
+        node = nodes[idx]
+        content = node.node.get_content()
+        overhead = NODE_OVERHEAD_TOKENS + count_tokens(str(node.node.metadata))
+        allowance = budget - used - overhead
+        if max_node_tokens is not None:
+            allowance = min(allowance, max_node_tokens)
+
+        tokens = count_tokens(content)
+        if tokens > allowance:
+            if allowance < min_node_tokens:
+                dropped.append(node)
+                continue
+            content = trim_to_tokens(content, allowance)
+            if not content.strip():
+                dropped.append(node)
+                continue
+            tokens = len(_tokenizer()(content))
+            trimmed_node = node.node.model_copy()
+            trimmed_node.set_content(content)
+            node = NodeWithScore(node=trimmed_node, score=node.score)
+            trimmed.append(node.node.node_id)
+
+        kept[idx] = node
+        used += tokens + overhead
+
+    return PackedContext(
+        nodes=[kept[idx] for idx in sorted(kept)],
+        dropped=dropped,
+        trimmed=trimmed,
+        tokens=used,
+        budget=budget,
+    )
@@ -1,9 +1,19 @@
-from typing import List, Optional, Set, Union, Generator, Iterator, Dict, Any
-import requests
+from typing import List, Optional, Set, Union, Generator, Iterator, Dict, Any, AsyncGenerator
+import asyncio
+from contextlib import nullcontext
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import httpx
 from llama_index.core.schema import (
     Document
 )
 
+from libs.limits import BackendBusy, BackendLimiter
+
 def string_metadata_dict(metadata: Dict[str, Any]) -> str:
     result = []
     if 'url' in metadata.keys():
@@ -19,6 +29,135 @@ def string_metadata_dict(metadata: Dict[str, Any]) -> str:
     return " · ".join(result)
 
 
+"""
+==============================================
+    Crawled page cache
+==============================================
+"""
+
+TRACKING_QUERY_PARAMS: Set[str] = {"gclid", "fbclid", "msclkid", "yclid", "mc_cid", "mc_eid", "ref_src"}
+
+
+def canonicalize_url(url: str) -> str:
+    """Normalize a URL so that trivially different links to the same page share a cache entry"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    port = parts.port
+    if port and not ((scheme == "http" and port == 80) or (scheme == "https" and port == 443)):
+        host = f"{host}:{port}"
+
+    path = parts.path or "/"
+    if len(path) > 1:
+        path = path.rstrip("/")
+
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith("utm_") and key.lower() not in TRACKING_QUERY_PARAMS
+    ))
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+class CrawlCache:
+    """On-disk (SQLite) cache of crawled pages keyed by canonical URL.
+
+    Entries expire after `ttl` seconds; when more than `max_entries` are stored
+    the least recently read ones are evicted.
+    """
+
+    path: str
+    ttl: float
+    max_entries: int
+
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(
+        self,
+        path: str = os.path.join(os.path.dirname(__file__), "..", ".cache", "crawl4ai.sqlite3"),
+        ttl: float = 60 * 60 * 24 * 7,
+        max_entries: int = 5000,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " url TEXT PRIMARY KEY,"
+            " text TEXT NOT NULL,"
+            " metadata TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)")
+        self._connection.commit()
+
+    def get_many(self, urls: List[str]) -> Dict[str, Document]:
+        """Return cached documents for `urls`, keyed by the URL as it was passed in"""
+        now = time.time()
+        result: Dict[str, Document] = {}
+        with self._lock:
+            for url in urls:
+                row = self._connection.execute(
+                    "SELECT text, metadata FROM pages WHERE url = ? AND created_at > ?",
+                    (canonicalize_url(url), now - self.ttl)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                result[url] = Document(
+                    doc_id=url,
+                    text=row[0],
+                    mimetype="text/markdown",
+                    metadata=json.loads(row[1])
+                )
+            if result:
+                self._connection.executemany(
+                    "UPDATE pages SET accessed_at = ? WHERE url = ?",
+                    [(now, canonicalize_url(url)) for url in result.keys()]
+                )
+                self._connection.commit()
+        return result
+
+    def put_many(self, documents: List[Document]) -> None:
+        """Pages without text (a failed or empty crawl) are not cached"""
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO pages (url, text, metadata, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (canonicalize_url(document.metadata.get("url") or document.doc_id), document.text,
+                     json.dumps(document.metadata), now, now)
+                    for document in documents
+                    if document.text
+                ]
+            )
+            self._connection.execute("DELETE FROM pages WHERE created_at <= ?", (now - self.ttl,))
+            self._connection.execute(
+                "DELETE FROM pages WHERE url IN ("
+                " SELECT url FROM pages ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._connection.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
 """ 
 ==============================================
     Custom Web Crawler Crawl4AI
@@ -27,11 +166,21 @@ def string_metadata_dict(metadata: Dict[str, Any]) -> str:
 
 
 class Crawl4AiReader:
+    """Client for the crawl4ai docker API.
+
+    One reader (and its HTTP connection pool) is meant to be shared by all
+    requests, see `resources.crawl_reader()`. `timeout` bounds a whole crawl call,
+    including the wait for a slot of the optional `limiter`; `page_timeout` is
+    forwarded to crawl4ai as the per-URL page timeout.
+    """
 
     # Same token set in CRAWL4AI_API_TOKEN
     auth_secret: str = "Bloomers2_Suffix_Feisty_Gnarly_Version_Blinks"
 
     base_url: str
+    timeout: float
+    page_timeout: float
+    max_connections: int
 
     default_config: Dict[str, Any] = {
         "priority": 10,
@@ -68,67 +217,220 @@ class Crawl4AiReader:
 
     headers: Dict[str, str] = {}
 
-    def __init__(self, base_url: str = "http://192.168.88.100:11235"):
+    cache: Optional[CrawlCache]
+    limiter: Optional[BackendLimiter]
+
+    _client: Optional[httpx.AsyncClient]
+
+    def __init__(
+        self,
+        base_url: str = "http://192.168.88.100:11235",
+        timeout: float = 30.0,
+        page_timeout: float = 15.0,
+        max_connections: int = 10,
+        cache: Optional[CrawlCache] = None,
+        limiter: Optional[BackendLimiter] = None,
+    ):
         self.base_url = base_url
+        self.cache = cache
+        self.limiter = limiter
+        self.timeout = timeout
+        self.page_timeout = page_timeout
+        self.max_connections = max_connections
+        self._client = None
 
-    async def crawl_urls(self, urls: str | List[str], user_request_data: dict, timeout: int = 300) -> dict | None:
-        try:
-            # Submit crawl job
-            request_data = {
-                "urls": urls,
-                "browser_config": self.browser_config_payload,
-                "crawler_config": self.crawler_config_payload
-            }
-            response = requests.post(
-                url=f"{self.base_url}/crawl",
-                json=request_data
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self.headers,
+                timeout=httpx.Timeout(self.timeout, connect=5.0),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
             )
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
-            if response.ok:
+    def _slot(self, timeout: float):
+        return self.limiter.slot(timeout=timeout) if self.limiter is not None else nullcontext()
+
+    def _request_data(self, urls: str | List[str], stream: bool) -> Dict[str, Any]:
+        return {
+            "urls": [urls] if isinstance(urls, str) else urls,
+            "browser_config": self.browser_config_payload,
+            "crawler_config": {
+                **self.crawler_config_payload,
+                "params": {
+                    **self.crawler_config_payload["params"],
+                    "stream": stream,
+                    "page_timeout": int(self.page_timeout * 1000),
+                },
+            },
+        }
+
+    async def crawl_urls(self, urls: str | List[str], user_request_data: dict = {}, timeout: Optional[float] = None) -> dict | None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        try:
+            async with self._slot(timeout or self.timeout):
+                # Submit crawl job
+                response = await asyncio.wait_for(
+                    self.client.post(
+                        url="/crawl",
+                        json=self._request_data(urls, stream=False)
+                    ),
+                    timeout=max(0.0, deadline - loop.time())
+                )
+
+            if response.is_success:
                 return response.json()
             else:
                 return None
 
+        except asyncio.TimeoutError:
+            print(f"[crawl_urls] Timed out after {timeout or self.timeout}s")
+            return {}
+        except BackendBusy as busy:
+            print(f"[crawl_urls] {busy}")
+            return {}
         except Exception as inst:
             print(type(inst))    # the exception type
             print(inst.args)     # arguments stored in .args
             print(inst)
             return {}
 
+    async def stream_crawl_urls(self, urls: str | List[str], timeout: Optional[float] = None) -> AsyncGenerator[Dict[str, Any], None]:
+        """Yield crawl results one by one, as crawl4ai finishes each URL.
+
+        Stops quietly once `timeout` is spent; results received so far are kept.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        try:
+            async with self._slot(timeout or self.timeout), self.client.stream(
+                "POST",
+                url="/crawl/stream",
+                json=self._request_data(urls, stream=True)
+            ) as response:
+                if not response.is_success:
+                    return
+
+                lines = response.aiter_lines()
+                while True:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    try:
+                        line = await asyncio.wait_for(anext(lines), timeout=remaining)
+                    except StopAsyncIteration:
+                        return
+
+                    if not line.strip():
+                        continue
+                    web_document = json.loads(line)
+                    if web_document.get('status') == 'completed':
+                        return
+                    yield web_document
+
+        except asyncio.TimeoutError:
+            print(f"[stream_crawl_urls] Timed out after {timeout or self.timeout}s")
+        except BackendBusy as busy:
+            print(f"[stream_crawl_urls] {busy}")
+        except Exception as inst:
+            print(f"[stream_crawl_urls] Exception: {inst}")
+
+    @staticmethod
+    def _to_document(web_document: Dict[str, Any]) -> Document | None:
+        try:
+            if not web_document.get('success'):
+                return None
+
+            _metadata = web_document.get('metadata') or {}
+            _markdown = web_document.get('markdown') or {}
+            _cleaned_html = web_document.get('cleaned_html')
+
+            return Document(
+                doc_id=web_document.get('url'),
+                text=_markdown.get(
+                    "markdown_with_citations", _cleaned_html),
+                mimetype="text/markdown",
+                metadata={
+                    "url": web_document.get('url'),
+                    "title": _metadata.get('title', ''),
+                    "description": _metadata.get('description', '')
+                }
+            )
+        except Exception as e:
+            print(f"[read_markdown_documents] Exception: {e}")
+            return None
+
+    async def _cached_documents(self, urls: List[str]) -> Dict[str, Document]:
+        if self.cache is None or not urls:
+            return {}
+        try:
+            return await asyncio.to_thread(self.cache.get_many, urls)
+        except Exception as e:
+            print(f"[CrawlCache] Exception: {e}")
+            return {}
+
+    async def _cache_documents(self, documents: List[Document]) -> None:
+        if self.cache is None or not documents:
+            return
+        try:
+            await asyncio.to_thread(self.cache.put_many, documents)
+        except Exception as e:
+            print(f"[CrawlCache] Exception: {e}")
+
     async def read_markdown_documents(self, urls: str | List[str], request_data: dict = {}) -> List[Document]:
-        crawl_response = await self.crawl_urls(urls, request_data)
+        _urls = [urls] if isinstance(urls, str) else urls
+        cached = await self._cached_documents(_urls)
+        result: List[Document] = list(cached.values())
+
+        missing_urls = [url for url in _urls if url not in cached]
+        if not missing_urls:
+            return result
+
+        crawl_response = await self.crawl_urls(missing_urls, request_data)
 
         if not crawl_response:
-            return []
+            return result
 
         if not crawl_response.get('results'):
-            return []
+            return result
 
-        result: List[Document] = []
+        crawled: List[Document] = []
         for web_document in crawl_response["results"]:
-            try:
-                if not web_document.get('success'):
-                    continue
+            document = self._to_document(web_document)
+            if document is not None:
+                crawled.append(document)
 
-                _metadata = web_document.get('metadata')
-                _markdown = web_document.get('markdown')
-                _cleaned_html = web_document.get('cleaned_html')
-
-                result.append(
-                    Document(
-                        doc_id=web_document.get('url'),
-                        text=_markdown.get(
-                            "markdown_with_citations", _cleaned_html),
-                        mimetype="text/markdown",
-                        metadata={
-                            "url": web_document.get('url'),
-                            "title": _metadata.get('title', ''),
-                            "description": _metadata.get('description', '')
-                        }
-                    )
-                )
-            except Exception as e:
-                print(f"[read_markdown_documents] Exception: {e}")
-                continue
+        await self._cache_documents(crawled)
+        return result + crawled
 
-        return result
+    async def stream_markdown_documents(self, urls: str | List[str], timeout: Optional[float] = None) -> AsyncGenerator[Document, None]:
+        """Streaming variant of `read_markdown_documents`: cached pages first, then pages as soon as they are crawled"""
+        _urls = [urls] if isinstance(urls, str) else urls
+        cached = await self._cached_documents(_urls)
+        for document in cached.values():
+            yield document
+
+        missing_urls = [url for url in _urls if url not in cached]
+        if not missing_urls:
+            return
+
+        crawled: List[Document] = []
+        try:
+            async for web_document in self.stream_crawl_urls(missing_urls, timeout=timeout):
+                document = self._to_document(web_document)
+                if document is not None:
+                    crawled.append(document)
+                    yield document
+        finally:
+            await self._cache_documents(crawled)
@@ -0,0 +1,147 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+"""
+==============================================
+    Cross-request embedding micro-batcher
+==============================================
+"""
+
+
+class EmbeddingBatcher:
+    """Coalesces text embedding calls of concurrent requests into shared batches.
+
+    Texts queued within `window` seconds of each other are sent to the model in
+    one call, up to `batch_size` texts per call. The batch size adapts to the
+    observed latency: full batches that come back faster than half of
+    `target_latency` double it, batches slower than `target_latency` halve it.
+    At most `max_concurrent_batches` calls are in flight at once; the rest wait
+    in the queue and join the next batch.
+    """
+
+    window: float
+    batch_size: int
+    min_batch_size: int
+    max_batch_size: int
+    target_latency: float
+    max_concurrent_batches: int
+
+    batches: int = 0
+    texts: int = 0
+
+    def __init__(
+        self,
+        embed: Callable[[List[str]], Awaitable[List[List[float]]]],
+        window: float = 0.01,
+        batch_size: int = 64,
+        min_batch_size: int = 8,
+        max_batch_size: int = 1024,
+        target_latency: float = 1.0,
+        max_concurrent_batches: int = 2,
+    ):
+        self.window = window
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        self.max_concurrent_batches = max_concurrent_batches
+        self.batches = 0
+        self.texts = 0
+        self._embed = embed
+        self._pending: List[Tuple[str, "asyncio.Future[List[float]]"]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional["asyncio.Task[None]"] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._last_latency: float = 0.0
+
+    def _ensure_worker(self) -> None:
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        self._ensure_worker()
+        assert self._wakeup is not None
+
+        loop = asyncio.get_running_loop()
+        futures: List["asyncio.Future[List[float]]"] = []
+        for text in texts:
+            future: "asyncio.Future[List[float]]" = loop.create_future()
+            self._pending.append((text, future))
+            futures.append(future)
+        self._wakeup.set()
+        return list(await asyncio.gather(*futures))
+
+    async def _run(self) -> None:
+        assert self._wakeup is not None and self._slots is not None
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            # Give other requests a moment to queue their texts, unless a batch is already full
+            if len(self._pending) < self.batch_size:
+                await asyncio.sleep(self.window)
+
+            while self._pending:
+                await self._slots.acquire()
+                batch = [
+                    (text, future)
+                    for text, future in self._pending[: self.batch_size]
+                    if not future.done()
+                ]
+                del self._pending[: self.batch_size]
+                if not batch:
+                    self._slots.release()
+                    continue
+                asyncio.ensure_future(self._send(batch))
+
+    async def _send(self, batch: List[Tuple[str, "asyncio.Future[List[float]]"]]) -> None:
+        assert self._slots is not None
+        started_at = time.monotonic()
+        try:
+            embeddings = await self._embed([text for text, _ in batch])
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        else:
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+            self._adapt(len(batch), time.monotonic() - started_at)
+        finally:
+            self._slots.release()
+
+    def _adapt(self, size: int, latency: float) -> None:
+        self.batches += 1
+        self.texts += size
+        self._last_latency = latency
+        if latency > self.target_latency:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        elif size >= self.batch_size and latency < self.target_latency / 2:
+            self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+
+    def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for _, future in self._pending:
+            if not future.done():
+                future.cancel()
+        self._pending.clear()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "batch_size": self.batch_size,
+            "mean_batch": round(self.texts / self.batches, 2) if self.batches else 0.0,
+            "last_latency": round(self._last_latency, 3),
+            "pending": len(self._pending),
+        }
@@ -0,0 +1,428 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.embeddings import BaseEmbedding
+
+from libs.embedding_batcher import EmbeddingBatcher
+from libs.limits import BackendLimiter
+
+
+"""
+==============================================
+    Content-hash embedding cache
+==============================================
+"""
+
+
+class EmbeddingCache:
+    """Text embeddings of one model, stored as float16 rows of a memory-mapped file.
+
+    Rows are addressed by the hash of the embedded text; the key -> row index is
+    kept in LRU order and written next to the vectors (`<model>.index.json`) every
+    `flush_interval` seconds, from a background thread. When all `capacity` rows
+    are taken the least recently used one is reused. The hash of the text stored
+    in every row is kept in `<model>.keys` and checked on every read, so an index
+    written before a row was reused never returns another text's embedding.
+    """
+
+    directory: str
+    model_name: str
+    capacity: int
+    flush_interval: float
+
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(
+        self,
+        model_name: str,
+        directory: str = os.path.join(
+            os.path.dirname(__file__), "..", ".cache", "embeddings"
+        ),
+        capacity: int = 50000,
+        flush_interval: float = 30.0,
+    ):
+        self.model_name = model_name
+        self.directory = directory
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._slots: "OrderedDict[str, int]" = OrderedDict()
+        self._vectors: Optional[np.memmap] = None
+        self._keys: Optional[np.memmap] = None
+        self._dim: Optional[int] = None
+        self._dirty = False
+        self._flushing = False
+        self._flushed_at = time.monotonic()
+
+        os.makedirs(directory, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+        self._vectors_path = os.path.join(directory, f"{slug}.f16")
+        self._keys_path = os.path.join(directory, f"{slug}.keys")
+        self._index_path = os.path.join(directory, f"{slug}.index.json")
+        self._load()
+
+    # sha1 digest of the text stored in a row
+    KEY_BYTES = 20
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _load(self) -> None:
+        if not (
+            os.path.isfile(self._index_path)
+            and os.path.isfile(self._vectors_path)
+            and os.path.isfile(self._keys_path)
+        ):
+            return
+        try:
+            with open(self._index_path, "r") as index_file:
+                index = json.load(index_file)
+            if index.get("model_name") != self.model_name:
+                return
+            self._dim = int(index["dim"])
+            self.capacity = int(index["capacity"])
+            self._vectors = np.memmap(
+                self._vectors_path,
+                dtype=np.float16,
+                mode="r+",
+                shape=(self.capacity, self._dim),
+            )
+            self._keys = np.memmap(
+                self._keys_path,
+                dtype=np.uint8,
+                mode="r+",
+                shape=(self.capacity, self.KEY_BYTES),
+            )
+            # Rows reused after the index was written hold another text now
+            self._slots = OrderedDict(
+                (key, int(slot))
+                for key, slot in index["slots"]
+                if self._keys[int(slot)].tobytes() == bytes.fromhex(key)
+            )
+        except Exception as error:
+            print(f"[EmbeddingCache] Discarding unreadable cache {self._index_path}: {error}")
+            self._slots = OrderedDict()
+            self._vectors = None
+            self._keys = None
+            self._dim = None
+
+    def _allocate(self, dim: int) -> None:
+        self._dim = dim
+        self._vectors = np.memmap(
+            self._vectors_path,
+            dtype=np.float16,
+            mode="w+",
+            shape=(self.capacity, dim),
+        )
+        self._keys = np.memmap(
+            self._keys_path,
+            dtype=np.uint8,
+            mode="w+",
+            shape=(self.capacity, self.KEY_BYTES),
+        )
+        self._slots = OrderedDict()
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        result: List[Optional[List[float]]] = []
+        with self._lock:
+            for text in texts:
+                key = self.key(text)
+                slot = self._slots.get(key)
+                if slot is None or self._vectors is None or self._keys is None:
+                    self.misses += 1
+                    result.append(None)
+                    continue
+                if self._keys[slot].tobytes() != bytes.fromhex(key):
+                    self._slots.pop(key, None)
+                    self.misses += 1
+                    result.append(None)
+                    continue
+                self._slots.move_to_end(key)
+                self.hits += 1
+                result.append(self._vectors[slot].astype(np.float32).tolist())
+        return result
+
+    def put_many(self, texts: Sequence[str], embeddings: Sequence[List[float]]) -> None:
+        if not texts:
+            return
+        with self._lock:
+            dim = len(embeddings[0])
+            if self._vectors is None or self._keys is None or self._dim != dim:
+                self._allocate(dim)
+            assert self._vectors is not None and self._keys is not None
+
+            for text, embedding in zip(texts, embeddings):
+                key = self.key(text)
+                slot = self._slots.get(key)
+                if slot is None:
+                    if len(self._slots) < self.capacity:
+                        slot = len(self._slots)
+                    else:
+                        _, slot = self._slots.popitem(last=False)
+                self._vectors[slot] = np.asarray(embedding, dtype=np.float16)
+                self._keys[slot] = np.frombuffer(bytes.fromhex(key), dtype=np.uint8)
+                self._slots[key] = slot
+                self._slots.move_to_end(key)
+            self._dirty = True
+
+            flush_due = (
+                not self._flushing
+                and time.monotonic() - self._flushed_at > self.flush_interval
+            )
+            if flush_due:
+                self._flushing = True
+                self._flushed_at = time.monotonic()
+
+        if flush_due:
+            # `put_many` runs on the event loop; the index JSON is written elsewhere
+            threading.Thread(target=self._flush_in_background, daemon=True).start()
+
+    def _flush_in_background(self) -> None:
+        try:
+            self.flush()
+        except Exception as error:
+            print(f"[EmbeddingCache] Exception: {error}")
+        finally:
+            self._flushing = False
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                self._flushed_at = time.monotonic()
+                if not self._dirty or self._vectors is None or self._keys is None:
+                    return
+                index = {
+                    "model_name": self.model_name,
+                    "dim": self._dim,
+                    "capacity": self.capacity,
+                    "slots": list(self._slots.items()),
+                }
+                vectors, keys = self._vectors, self._keys
+                self._dirty = False
+
+            try:
+                vectors.flush()
+                keys.flush()
+                tmp_path = self._index_path + ".tmp"
+                with open(tmp_path, "w") as index_file:
+                    json.dump(index, index_file)
+                os.replace(tmp_path, self._index_path)
+            except Exception:
+                with self._lock:
+                    self._dirty = True
+                raise
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._slots)}
+
+
+class QueryEmbeddingCache:
+    """Process-wide in-memory LRU of query embeddings keyed by (model, text).
+
+    Queries are short and repeat across requests and users, so they are kept in
+    memory rather than in the on-disk `EmbeddingCache`. Concurrent misses for the
+    same key share one call to the model.
+    """
+
+    max_entries: int
+
+    hits: int = 0
+    misses: int = 0
+    deduplicated: int = 0
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str], List[float]]" = OrderedDict()
+        self._in_flight: Dict[Tuple[str, str], "asyncio.Task[List[float]]"] = {}
+
+    def get(self, model_name: str, text: str) -> Optional[List[float]]:
+        key = (model_name, text)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return embedding
+
+    def put(self, model_name: str, text: str, embedding: List[float]) -> None:
+        key = (model_name, text)
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(
+        self, model_name: str, text: str, compute: Callable[[str], List[float]]
+    ) -> List[float]:
+        embedding = self.get(model_name, text)
+        if embedding is None:
+            self.misses += 1
+            embedding = compute(text)
+            self.put(model_name, text, embedding)
+        return embedding
+
+    async def _compute_and_store(
+        self,
+        key: Tuple[str, str],
+        compute: Callable[[str], Awaitable[List[float]]],
+    ) -> List[float]:
+        try:
+            embedding = await compute(key[1])
+            self.put(key[0], key[1], embedding)
+            return embedding
+        finally:
+            self._in_flight.pop(key, None)
+
+    async def aget_or_compute(
+        self,
+        model_name: str,
+        text: str,
+        compute: Callable[[str], Awaitable[List[float]]],
+    ) -> List[float]:
+        embedding = self.get(model_name, text)
+        if embedding is not None:
+            return embedding
+
+        key = (model_name, text)
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.deduplicated += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._compute_and_store(key, compute))
+            self._in_flight[key] = task
+
+        # One caller giving up must not cancel the call for everybody else
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "deduplicated": self.deduplicated,
+            "entries": len(self._entries),
+        }
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Embedding model wrapper that looks up text (document chunk) embeddings in an
+    `EmbeddingCache` and only sends the misses to the wrapped model. Query
+    embeddings go through the optional `QueryEmbeddingCache`. With a `batcher`, async
+    cache misses are coalesced with those of concurrent requests; other async calls
+    to the wrapped model take a slot of the optional `limiter`."""
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+    _query_cache: Optional[QueryEmbeddingCache] = PrivateAttr()
+    _batcher: Optional[EmbeddingBatcher] = PrivateAttr()
+    _limiter: Optional[BackendLimiter] = PrivateAttr()
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        cache: EmbeddingCache,
+        query_cache: Optional[QueryEmbeddingCache] = None,
+        batcher: Optional[EmbeddingBatcher] = None,
+        limiter: Optional[BackendLimiter] = None,
+        **kwargs: Any,
+    ):
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            callback_manager=embed_model.callback_manager,
+            **kwargs,
+        )
+        self._embed_model = embed_model
+        self._cache = cache
+        self._query_cache = query_cache
+        self._batcher = batcher
+        self._limiter = limiter
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def embed_model(self) -> BaseEmbedding:
+        return self._embed_model
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    @property
+    def query_cache(self) -> Optional[QueryEmbeddingCache]:
+        return self._query_cache
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        if self._query_cache is None:
+            return self._embed_model._get_query_embedding(query)
+        return self._query_cache.get_or_compute(
+            self.model_name, query, self._embed_model._get_query_embedding
+        )
+
+    async def _aembed_query(self, query: str) -> List[float]:
+        if self._limiter is None:
+            return await self._embed_model._aget_query_embedding(query)
+        async with self._limiter.slot():
+            return await self._embed_model._aget_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        if self._query_cache is None:
+            return await self._aembed_query(query)
+        return await self._query_cache.aget_or_compute(
+            self.model_name, query, self._aembed_query
+        )
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        cached = self._cache.get_many(texts)
+        missing = [idx for idx, embedding in enumerate(cached) if embedding is None]
+        if missing:
+            embeddings = self._embed_model._get_text_embeddings([texts[idx] for idx in missing])
+            self._cache.put_many([texts[idx] for idx in missing], embeddings)
+            for idx, embedding in zip(missing, embeddings):
+                cached[idx] = embedding
+        return cached  # type: ignore[return-value]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        cached = self._cache.get_many(texts)
+        missing = [idx for idx, embedding in enumerate(cached) if embedding is None]
+        if missing:
+            missing_texts = [texts[idx] for idx in missing]
+            if self._batcher is not None:
+                embeddings = await self._batcher.embed(missing_texts)
+            elif self._limiter is not None:
+                async with self._limiter.slot():
+                    embeddings = await self._embed_model._aget_text_embeddings(missing_texts)
+            else:
+                embeddings = await self._embed_model._aget_text_embeddings(missing_texts)
+            self._cache.put_many(missing_texts, embeddings)
+            for idx, embedding in zip(missing, embeddings):
+                cached[idx] = embedding
+        return cached  # type: ignore[return-value]
@@ -0,0 +1,85 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.schema import BaseNode, Document, MetadataMode, NodeWithScore
+
+
+"""
+==============================================
+    Ephemeral in-memory vector retriever
+==============================================
+"""
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class EphemeralVectorRetriever:
+    """Top-k cosine retriever over the chunks of a few documents, for one request only.
+
+    Stands in for `VectorStoreIndex.from_documents(...).as_retriever()` when the
+    index would be thrown away after a single query: chunk embeddings are stacked
+    into one normalized matrix and scored with a single matrix-vector product.
+    Scores are cosine similarities, same as `SimpleVectorStore`.
+    """
+
+    nodes: List[BaseNode]
+    embed_model: BaseEmbedding
+    similarity_top_k: int
+
+    def __init__(
+        self,
+        nodes: List[BaseNode],
+        embeddings: np.ndarray,
+        embed_model: BaseEmbedding,
+        similarity_top_k: int = 10,
+    ):
+        self.nodes = nodes
+        self.embed_model = embed_model
+        self.similarity_top_k = similarity_top_k
+        self._matrix = _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+
+    @classmethod
+    async def afrom_documents(
+        cls,
+        documents: Sequence[Document],
+        embed_model: BaseEmbedding,
+        similarity_top_k: int = 10,
+    ) -> "EphemeralVectorRetriever":
+        nodes = Settings.node_parser.get_nodes_from_documents(documents)
+        if not nodes:
+            return cls([], np.zeros((0, 0), dtype=np.float32), embed_model, similarity_top_k)
+
+        embeddings = await embed_model.aget_text_embedding_batch(
+            [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        )
+        return cls(nodes, np.asarray(embeddings, dtype=np.float32), embed_model, similarity_top_k)
+
+    async def aretrieve(
+        self, query: str, query_embedding: Optional[List[float]] = None
+    ) -> List[NodeWithScore]:
+        if not self.nodes:
+            return []
+
+        if query_embedding is None:
+            query_embedding = await self.embed_model.aget_query_embedding(query)
+
+        vector = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        scores = self._matrix @ (vector / norm if norm else vector)
+
+        top_k = min(self.similarity_top_k, len(self.nodes))
+        if top_k < len(self.nodes):
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(len(self.nodes))
+        winners = candidates[np.argsort(-scores[candidates])]
+
+        return [
+            NodeWithScore(node=self.nodes[idx], score=float(scores[idx])) for idx in winners
+        ]
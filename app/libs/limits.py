@@ -0,0 +1,300 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Optional,
+    TypeVar,
+)
+
+from libs.metrics import metrics
+
+
+"""
+==============================================
+    Backend concurrency limits
+==============================================
+"""
+
+T = TypeVar("T")
+
+# Calls in flight per backend, unless configured otherwise (`BACKEND_LIMITS`)
+DEFAULT_LIMITS: Dict[str, int] = {
+    "gemini": 16,
+    "ollama": 4,
+    "qdrant": 16,
+    "crawl4ai": 2,
+    "search": 4,
+    "completions": 32,
+}
+
+in_flight_gauge = metrics.gauge(
+    "backend_in_flight", "Calls holding a backend slot"
+)
+queue_depth_gauge = metrics.gauge(
+    "backend_queue_depth", "Calls waiting for a backend slot"
+)
+queue_wait_histogram = metrics.histogram(
+    "backend_queue_wait_seconds", "Time calls waited for a backend slot"
+)
+rejected_counter = metrics.counter(
+    "backend_rejected_total", "Calls that got no backend slot, by reason (queue_full, timeout)"
+)
+# LLM, embedding and retrieval latencies: how long calls held their slot
+call_duration_histogram = metrics.histogram(
+    "backend_call_seconds", "Duration of backend calls, streams until they end"
+)
+first_chunk_histogram = metrics.histogram(
+    "backend_first_chunk_seconds", "Time from the start of a streaming call to its first chunk"
+)
+
+
+def parse_limits(spec: str) -> Dict[str, int]:
+    """`gemini=8,ollama=4` -> `{"gemini": 8, "ollama": 4}`"""
+    limits: Dict[str, int] = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, value = item.partition("=")
+        limits[name.strip()] = int(value)
+    return limits
+
+
+class BackendBusy(RuntimeError):
+    """No backend slot: the queue is full or the wait exceeded the queue timeout"""
+
+
+class BackendLimiter:
+    """Bounds the calls in flight to one backend; calls over the limit wait in FIFO order.
+
+    At most `max_queue` calls wait, for at most `queue_timeout` seconds (`None`
+    waits as long as it takes); other calls fail fast with `BackendBusy`.
+    Queue depth, calls in flight, wait times and call durations go to the
+    process metrics with a `backend` label.
+    """
+
+    name: str
+    max_concurrent: int
+    max_queue: int
+    queue_timeout: Optional[float]
+
+    in_flight: int = 0
+    admitted: int = 0
+    queued: int = 0
+    rejected: int = 0
+    timed_out: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrent: int = 8,
+        max_queue: int = 64,
+        queue_timeout: Optional[float] = 10.0,
+    ):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._waiters: Deque["asyncio.Future[None]"] = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def saturated(self) -> bool:
+        """A new call would have to wait (or be rejected)"""
+        return self.in_flight >= self.max_concurrent or bool(self._waiters)
+
+    def _update_gauges(self) -> None:
+        in_flight_gauge.set(self.in_flight, backend=self.name)
+        queue_depth_gauge.set(len(self._waiters), backend=self.name)
+
+    def _admit(self, wait: float) -> float:
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        queue_wait_histogram.observe(wait, backend=self.name)
+        self._update_gauges()
+        return wait
+
+    async def acquire(self, timeout: Optional[float] = None) -> float:
+        """Take a slot, waiting at most `timeout` (default `queue_timeout`); returns the wait in seconds"""
+        if self.in_flight < self.max_concurrent and not self._waiters:
+            self.in_flight += 1
+            return self._admit(0.0)
+
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            rejected_counter.inc(backend=self.name, reason="queue_full")
+            raise BackendBusy(
+                f"{self.name} is busy: {self.in_flight} calls running, {len(self._waiters)} waiting"
+            )
+
+        started_at = time.monotonic()
+        waiter: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        self._update_gauges()
+        try:
+            await asyncio.wait_for(
+                waiter, timeout=self.queue_timeout if timeout is None else timeout
+            )
+        except BaseException as error:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over as the wait ended; pass it on
+                self.release()
+            else:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+                self._update_gauges()
+            if isinstance(error, asyncio.TimeoutError):
+                self.timed_out += 1
+                rejected_counter.inc(backend=self.name, reason="timeout")
+                raise BackendBusy(
+                    f"{self.name} is busy: no slot after {time.monotonic() - started_at:.1f}s"
+                ) from None
+            raise
+
+        # `release` handed its slot over, `in_flight` already counts this call
+        return self._admit(time.monotonic() - started_at)
+
+    def release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._update_gauges()
+                return
+        self.in_flight -= 1
+        self._update_gauges()
+
+    @asynccontextmanager
+    async def slot(self, timeout: Optional[float] = None) -> AsyncIterator[float]:
+        wait = await self.acquire(timeout)
+        started_at = time.perf_counter()
+        try:
+            yield wait
+        finally:
+            self.release()
+            call_duration_histogram.observe(
+                time.perf_counter() - started_at, backend=self.name
+            )
+
+    def wrap(self, call: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        """`call` taking a slot for every invocation"""
+
+        async def limited(*args: Any, **kwargs: Any) -> T:
+            async with self.slot():
+                return await call(*args, **kwargs)
+
+        return limited
+
+    async def stream(self, start: Awaitable[AsyncIterator[T]]) -> "LimitedStream[T]":
+        """Start a streaming call and hold its slot until the stream ends or is closed"""
+        try:
+            await self.acquire()
+        except BaseException:
+            # `start` is an un-awaited coroutine; don't leave it dangling
+            close = getattr(start, "close", None)
+            if close is not None:
+                close()
+            raise
+        started_at = time.perf_counter()
+        try:
+            return LimitedStream(self, await start, started_at)
+        except BaseException:
+            self.release()
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": len(self._waiters),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait": round(self.total_wait / self.admitted, 4) if self.admitted else 0.0,
+            "max_wait": round(self.max_wait, 4),
+        }
+
+
+class LimitedStream(AsyncIterator[T]):
+    """Async iterator over a backend stream that releases its limiter slot once,
+    when the stream is exhausted, fails or is closed (`aclose`), iterated or not.
+
+    Consumers must close streams they abandon; a stream collected unclosed is
+    reported and its slot released on the event loop, as a last resort.
+    """
+
+    def __init__(
+        self,
+        limiter: BackendLimiter,
+        stream: AsyncIterator[T],
+        started_at: Optional[float] = None,
+    ):
+        self._limiter = limiter
+        self._stream = stream
+        self._started_at = time.perf_counter() if started_at is None else started_at
+        self._first_chunk = True
+        self._released = False
+        self._loop = asyncio.get_running_loop()
+
+    def _release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._limiter.release()
+            call_duration_histogram.observe(
+                time.perf_counter() - self._started_at, backend=self._limiter.name
+            )
+
+    def __aiter__(self) -> "LimitedStream[T]":
+        return self
+
+    async def __anext__(self) -> T:
+        try:
+            chunk = await self._stream.__anext__()
+        except BaseException:
+            self._release()
+            raise
+        if self._first_chunk:
+            self._first_chunk = False
+            first_chunk_histogram.observe(
+                time.perf_counter() - self._started_at, backend=self._limiter.name
+            )
+        return chunk
+
+    async def aclose(self) -> None:
+        self._release()
+        aclose = getattr(self._stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+    def __del__(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        print(f"[LimitedStream] {self._limiter.name} stream was not closed, releasing its slot")
+        # GC may run on any thread; the limiter belongs to the event loop
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._limiter.release)
@@ -0,0 +1,197 @@
+import bisect
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+
+"""
+==============================================
+    Process metrics
+==============================================
+"""
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+# Seconds; covers a cache hit (ms) up to a slow LLM call
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+
+def _label_set(labels: Dict[str, str]) -> LabelSet:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: LabelSet, extra: LabelSet = ()) -> str:
+    if not labels and not extra:
+        return ""
+    pairs = [
+        '{}="{}"'.format(
+            key, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        )
+        for key, value in labels + extra
+    ]
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Monotonic counter with one value per label set"""
+
+    name: str
+    help: str
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values: Dict[LabelSet, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = _label_set(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> Dict[LabelSet, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+class Gauge:
+    """Current value (queue depth, calls in flight) with one value per label set"""
+
+    name: str
+    help: str
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values: Dict[LabelSet, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = _label_set(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self) -> Dict[LabelSet, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+class HistogramSample:
+    buckets: List[int]
+    count: int
+    sum: float
+
+    def __init__(self, size: int):
+        self.buckets = [0] * size
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram:
+    """Distribution of observed values in fixed buckets (upper bounds, `le`)"""
+
+    name: str
+    help: str
+    buckets: Tuple[float, ...]
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._values: Dict[LabelSet, HistogramSample] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _label_set(labels)
+        # Non-cumulative here, cumulative counts are computed when exported
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            sample = self._values.get(key)
+            if sample is None:
+                sample = self._values[key] = HistogramSample(len(self.buckets) + 1)
+            sample.buckets[position] += 1
+            sample.count += 1
+            sample.sum += value
+
+    def samples(self) -> Dict[LabelSet, HistogramSample]:
+        with self._lock:
+            snapshot: Dict[LabelSet, HistogramSample] = {}
+            for key, sample in self._values.items():
+                copy = HistogramSample(len(sample.buckets))
+                copy.buckets = list(sample.buckets)
+                copy.count = sample.count
+                copy.sum = sample.sum
+                snapshot[key] = copy
+            return snapshot
+
+
+class MetricsRegistry:
+    """Named process-wide metrics; asking twice for a name returns the same metric"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Counter] = {}
+        self._gauges: Dict[str, Gauge] = {}
+        self._histograms: Dict[str, Histogram] = {}
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        with self._lock:
+            if name not in self._counters:
+                self._counters[name] = Counter(name, help)
+            return self._counters[name]
+
+    def gauge(self, name: str, help: str = "") -> Gauge:
+        with self._lock:
+            if name not in self._gauges:
+                self._gauges[name] = Gauge(name, help)
+            return self._gauges[name]
+
+    def histogram(
+        self, name: str, help: str = "", buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram(name, help, buckets)
+            return self._histograms[name]
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+        with self._lock:
+            counters = sorted(self._counters.values(), key=lambda metric: metric.name)
+            gauges = sorted(self._gauges.values(), key=lambda metric: metric.name)
+            histograms = sorted(self._histograms.values(), key=lambda metric: metric.name)
+
+        lines: List[str] = []
+        for kind, scalars in (("counter", counters), ("gauge", gauges)):
+            for metric in scalars:
+                lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {kind}"]
+                for labels, value in sorted(metric.samples().items()):
+                    lines.append(f"{metric.name}{_format_labels(labels)} {_format_value(value)}")
+
+        for histogram in histograms:
+            lines += [
+                f"# HELP {histogram.name} {histogram.help}",
+                f"# TYPE {histogram.name} histogram",
+            ]
+            for labels, sample in sorted(histogram.samples().items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), sample.buckets):
+                    cumulative += count
+                    le = (("le", _format_value(bound)),)
+                    lines.append(
+                        f"{histogram.name}_bucket{_format_labels(labels, le)} {cumulative}"
+                    )
+                lines.append(f"{histogram.name}_sum{_format_labels(labels)} {_format_value(sample.sum)}")
+                lines.append(f"{histogram.name}_count{_format_labels(labels)} {sample.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,99 @@
+import hashlib
+import re
+from typing import List, Optional, Set
+
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+
+"""
+==============================================
+    Duplicate node removal
+==============================================
+"""
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def content_hash(text: str) -> str:
+    """Hash of the text with case and whitespace differences ignored"""
+    return hashlib.sha1(" ".join(text.lower().split()).encode("utf-8")).hexdigest()
+
+
+def simhash(text: str, shingle_size: int = 3) -> int:
+    """64-bit SimHash over word shingles; near-identical texts differ in few bits"""
+    words = _WORD_PATTERN.findall(text.lower())
+    if len(words) < shingle_size:
+        shingles = [" ".join(words)]
+    else:
+        shingles = [
+            " ".join(words[idx : idx + shingle_size])
+            for idx in range(len(words) - shingle_size + 1)
+        ]
+
+    weights = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(
+            hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big"
+        )
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return bin(first ^ second).count("1")
+
+
+class DeduplicateNodesPostprocessor(BaseNodePostprocessor):
+    """Drops repeated nodes, keeping the best scored copy.
+
+    Nodes are exact duplicates when they share a node id or a content hash, and
+    near-duplicates when the SimHash signatures of their contents are within
+    `max_hamming_distance` bits (boilerplate-only differences, the same page
+    crawled from two URLs). Output is ordered by score, best first.
+    """
+
+    max_hamming_distance: int = Field(default=3)
+    shingle_size: int = Field(default=3)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "DeduplicateNodesPostprocessor"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        seen_ids: Set[str] = set()
+        seen_hashes: Set[str] = set()
+        signatures: List[int] = []
+        kept: List[NodeWithScore] = []
+
+        ranked = sorted(
+            nodes,
+            key=lambda node: node.score if node.score is not None else float("-inf"),
+            reverse=True,
+        )
+        for node in ranked:
+            content = node.node.get_content()
+            digest = content_hash(content)
+            if node.node.node_id in seen_ids or digest in seen_hashes:
+                continue
+
+            signature = simhash(content, self.shingle_size)
+            if any(
+                hamming_distance(signature, other) <= self.max_hamming_distance
+                for other in signatures
+            ):
+                continue
+
+            seen_ids.add(node.node.node_id)
+            seen_hashes.add(digest)
+            signatures.append(signature)
+            kept.append(node)
+
+        return kept
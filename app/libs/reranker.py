@@ -0,0 +1,113 @@
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from llama_index.core.schema import NodeWithScore
+
+
+"""
+==============================================
+    Reranking service
+==============================================
+"""
+
+
+class RerankerService:
+    """ColBERT reranker loaded once per process and shared by all requests.
+
+    `rerank` scores candidates in batches of `batch_size`, best retrieval score
+    first, until the per-request `time_budget` runs out. Candidates left unscored
+    are kept after the scored ones in retrieval order. Results are truncated to
+    `top_n`. The retrieval score stays in `metadata["retrieval_score"]`.
+    """
+
+    model: str
+    device: str
+    batch_size: int
+
+    requests: int = 0
+    scored: int = 0
+    budget_exceeded: int = 0
+
+    def __init__(
+        self,
+        model: str = "colbert-ir/colbertv2.0",
+        device: str = "cpu",
+        batch_size: int = 16,
+    ):
+        self.model = model
+        self.device = device
+        self.batch_size = batch_size
+        self.requests = 0
+        self.scored = 0
+        self.budget_exceeded = 0
+        self._postprocessor: Optional[Any] = None
+        # One forward pass at a time: the model is shared and CPU-bound
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        with self._lock:
+            if self._postprocessor is None:
+                from llama_index.postprocessor.colbert_rerank import ColbertRerank
+
+                self._postprocessor = ColbertRerank(
+                    model=self.model,
+                    tokenizer=self.model,
+                    top_n=self.batch_size,
+                    keep_retrieval_score=True,
+                    device=self.device,
+                )
+
+    def _score_batch(self, query: str, batch: List[NodeWithScore]) -> List[NodeWithScore]:
+        self.load()
+        with self._lock:
+            assert self._postprocessor is not None
+            self._postprocessor.top_n = len(batch)
+            return self._postprocessor.postprocess_nodes(batch, query_str=query)
+
+    async def rerank(
+        self,
+        query: str,
+        nodes: List[NodeWithScore],
+        top_n: int = 8,
+        time_budget: float = 1.5,
+    ) -> List[NodeWithScore]:
+        self.requests += 1
+        if len(nodes) <= 1:
+            return nodes[:top_n]
+
+        candidates = sorted(
+            nodes,
+            key=lambda node: node.score if node.score is not None else float("-inf"),
+            reverse=True,
+        )
+        deadline = time.monotonic() + time_budget
+
+        scored: List[NodeWithScore] = []
+        position = 0
+        while position < len(candidates):
+            if time.monotonic() >= deadline:
+                self.budget_exceeded += 1
+                break
+            batch = candidates[position : position + self.batch_size]
+            try:
+                scored += await asyncio.to_thread(self._score_batch, query, batch)
+            except Exception as error:
+                print(f"[RerankerService] Exception: {error}")
+                break
+            position += len(batch)
+
+        self.scored += len(scored)
+        scored.sort(
+            key=lambda node: node.score if node.score is not None else float("-inf"),
+            reverse=True,
+        )
+        return (scored + candidates[position:])[:top_n]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "scored": self.scored,
+            "budget_exceeded": self.budget_exceeded,
+        }
@@ -0,0 +1,388 @@
+from collections import OrderedDict
+import threading
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+
+if TYPE_CHECKING:
+    from llama_index.core import VectorStoreIndex
+    from llama_index.core.embeddings import BaseEmbedding
+    from llama_index.core.llms import LLM
+
+    from libs.crawl4ai import Crawl4AiReader, CrawlCache
+    from libs.embedding_batcher import EmbeddingBatcher
+    from libs.embedding_cache import EmbeddingCache, QueryEmbeddingCache
+    from libs.limits import BackendLimiter
+    from libs.reranker import RerankerService
+    from libs.router import EmbeddingCentroidRouter
+    from libs.semantic_cache import SemanticAnswerCache
+    from libs.speculation import SpeculationStats
+    from libs.web_search import WebSearchService
+
+
+"""
+==============================================
+    Process-wide resource registry
+==============================================
+"""
+
+
+class ResourceRegistry:
+    """Creates LLM, embedding and vector store clients once and shares them between requests.
+
+    Vector store indexes are kept in an LRU keyed by collection name. Per-request
+    settings (temperature, max tokens) are not baked into the shared LLM, they are
+    passed at call time — see `llm_call_kwargs`.
+    """
+
+    index_cache_size: int
+
+    def __init__(self, index_cache_size: int = 16):
+        self.index_cache_size = index_cache_size
+        self._lock = threading.Lock()
+        self._limiters: Dict[str, "BackendLimiter"] = {}
+        self._limiter_settings: Dict[str, Dict[str, Any]] = {}
+        self._llms: Dict[Tuple[str, str], "LLM"] = {}
+        self._embeddings: Dict[Tuple[str, str, int], "BaseEmbedding"] = {}
+        self._embedding_caches: Dict[str, "EmbeddingCache"] = {}
+        self._query_embedding_cache: Optional["QueryEmbeddingCache"] = None
+        self._embedding_batchers: Dict[Tuple[str, str], "EmbeddingBatcher"] = {}
+        self._qdrant_clients: Dict[str, Any] = {}
+        self._async_qdrant_clients: Dict[str, Any] = {}
+        self._crawl_readers: Dict[str, "Crawl4AiReader"] = {}
+        self._crawl_cache: Optional["CrawlCache"] = None
+        self._web_search: Optional["WebSearchService"] = None
+        self._semantic_cache: Optional["SemanticAnswerCache"] = None
+        self._routers: Dict[str, "EmbeddingCentroidRouter"] = {}
+        self._speculation_stats: Dict[str, "SpeculationStats"] = {}
+        self._reranker: Optional["RerankerService"] = None
+        self._indexes: "OrderedDict[Tuple[str, str, int], VectorStoreIndex]" = (
+            OrderedDict()
+        )
+
+    def configure_limits(
+        self,
+        limits: Dict[str, int],
+        max_queue: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+    ) -> None:
+        """Concurrency limits per backend (`{"gemini": 8}`); `max_queue` and
+        `queue_timeout` apply to all backends. Call before the first request."""
+        settings: Dict[str, Any] = {}
+        if max_queue is not None:
+            settings["max_queue"] = max_queue
+        if queue_timeout is not None:
+            settings["queue_timeout"] = queue_timeout
+
+        from libs.limits import DEFAULT_LIMITS
+
+        with self._lock:
+            for name in set(DEFAULT_LIMITS) | set(limits) | set(self._limiters):
+                self._limiter_settings[name] = {**settings}
+                if name in limits:
+                    self._limiter_settings[name]["max_concurrent"] = limits[name]
+                limiter = self._limiters.get(name)
+                if limiter is not None:
+                    for key, value in self._limiter_settings[name].items():
+                        setattr(limiter, key, value)
+
+    def limiter(self, name: str) -> "BackendLimiter":
+        """Concurrency limiter of a backend (gemini, ollama, qdrant, crawl4ai, search) or of
+        completions accepted by the server (completions), shared by all requests"""
+        with self._lock:
+            if name not in self._limiters:
+                from libs.limits import DEFAULT_LIMITS, BackendLimiter
+
+                settings = {
+                    "max_concurrent": DEFAULT_LIMITS.get(name, 8),
+                    **self._limiter_settings.get(name, {}),
+                }
+                self._limiters[name] = BackendLimiter(name, **settings)
+            return self._limiters[name]
+
+    def limiter_stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return {limiter.name: limiter.stats() for limiter in limiters}
+
+    def llm(self, model: str, api_key: str) -> "LLM":
+        key = (model, api_key)
+        with self._lock:
+            if key not in self._llms:
+                from llama_index.llms.gemini import Gemini
+
+                self._llms[key] = Gemini(model=model, api_key=api_key)
+            return self._llms[key]
+
+    def embedding(
+        self, model_name: str, base_url: str, embed_batch_size: int = 256
+    ) -> "BaseEmbedding":
+        """Ollama embedding model; text embeddings are served from `EmbeddingCache` and
+        query embeddings from the process-wide `QueryEmbeddingCache` when possible.
+        Text embedding misses of all requests to the same Ollama model share one
+        `EmbeddingBatcher`, whatever `embed_batch_size` they were created with.
+        Calls to Ollama go through the `ollama` limiter."""
+        ollama_limiter = self.limiter("ollama")
+        key = (model_name, base_url, embed_batch_size)
+        with self._lock:
+            if key not in self._embeddings:
+                from llama_index.embeddings.ollama import OllamaEmbedding
+                from libs.embedding_batcher import EmbeddingBatcher
+                from libs.embedding_cache import (
+                    CachedEmbedding,
+                    EmbeddingCache,
+                    QueryEmbeddingCache,
+                )
+
+                if model_name not in self._embedding_caches:
+                    self._embedding_caches[model_name] = EmbeddingCache(
+                        model_name=model_name
+                    )
+                if self._query_embedding_cache is None:
+                    self._query_embedding_cache = QueryEmbeddingCache()
+
+                embed_model = OllamaEmbedding(
+                    model_name=model_name,
+                    base_url=base_url,
+                    embed_batch_size=embed_batch_size,
+                )
+                if (model_name, base_url) not in self._embedding_batchers:
+                    self._embedding_batchers[(model_name, base_url)] = EmbeddingBatcher(
+                        embed=ollama_limiter.wrap(embed_model._aget_text_embeddings)
+                    )
+
+                self._embeddings[key] = CachedEmbedding(
+                    embed_model=embed_model,
+                    cache=self._embedding_caches[model_name],
+                    query_cache=self._query_embedding_cache,
+                    batcher=self._embedding_batchers[(model_name, base_url)],
+                    limiter=ollama_limiter,
+                )
+            return self._embeddings[key]
+
+    def qdrant_client(self, url: str) -> Any:
+        with self._lock:
+            if url not in self._qdrant_clients:
+                import qdrant_client
+
+                self._qdrant_clients[url] = qdrant_client.QdrantClient(url=url)
+            return self._qdrant_clients[url]
+
+    def async_qdrant_client(self, url: str) -> Any:
+        with self._lock:
+            if url not in self._async_qdrant_clients:
+                import qdrant_client
+
+                self._async_qdrant_clients[url] = qdrant_client.AsyncQdrantClient(
+                    url=url
+                )
+            return self._async_qdrant_clients[url]
+
+    def crawl_cache(self) -> "CrawlCache":
+        with self._lock:
+            if self._crawl_cache is None:
+                from libs.crawl4ai import CrawlCache
+
+                self._crawl_cache = CrawlCache()
+            return self._crawl_cache
+
+    def crawl_reader(self, base_url: Optional[str] = None) -> "Crawl4AiReader":
+        """Crawl4AI reader with a pooled HTTP client, one per crawler URL"""
+        from libs.crawl4ai import Crawl4AiReader
+
+        cache = self.crawl_cache()
+        limiter = self.limiter("crawl4ai")
+        key = base_url or ""
+        with self._lock:
+            if key not in self._crawl_readers:
+                self._crawl_readers[key] = (
+                    Crawl4AiReader(base_url=base_url, cache=cache, limiter=limiter)
+                    if base_url
+                    else Crawl4AiReader(cache=cache, limiter=limiter)
+                )
+            return self._crawl_readers[key]
+
+    def web_search(self) -> "WebSearchService":
+        limiter = self.limiter("search")
+        with self._lock:
+            if self._web_search is None:
+                from libs.web_search import WebSearchService
+
+                self._web_search = WebSearchService(limiter=limiter)
+            return self._web_search
+
+    def semantic_cache(self) -> "SemanticAnswerCache":
+        with self._lock:
+            if self._semantic_cache is None:
+                from libs.semantic_cache import SemanticAnswerCache
+
+                self._semantic_cache = SemanticAnswerCache()
+            return self._semantic_cache
+
+    def router(
+        self,
+        name: str,
+        embed_model: "BaseEmbedding",
+        enabled: bool = False,
+        confidence_threshold: float = 0.08,
+    ) -> "EmbeddingCentroidRouter":
+        """Local TASK / QUERY router of a workflow; LLM verdicts are logged to `.cache/router/<name>.jsonl`"""
+        with self._lock:
+            if name not in self._routers:
+                import os
+                from libs.router import EmbeddingCentroidRouter
+
+                self._routers[name] = EmbeddingCentroidRouter(
+                    embed_model=embed_model,
+                    log_path=os.path.join(
+                        os.path.dirname(__file__), "..", ".cache", "router", f"{name}.jsonl"
+                    ),
+                )
+            router = self._routers[name]
+            router.enabled = enabled
+            router.confidence_threshold = confidence_threshold
+            return router
+
+    def reranker(self, load: bool = True) -> "RerankerService":
+        """CPU reranker; the model is loaded on the first call, call it at startup.
+
+        Blocks while the model loads; on the event loop pass `load=False`, the
+        service then loads it on its worker thread with the first batch.
+        """
+        with self._lock:
+            if self._reranker is None:
+                from libs.reranker import RerankerService
+
+                self._reranker = RerankerService()
+            reranker = self._reranker
+        if load:
+            reranker.load()
+        return reranker
+
+    @staticmethod
+    def rerank_kwargs(top_n: int, time_budget: float) -> Dict[str, Any]:
+        """Per-workflow reranker settings (`reranker.rerank(query, nodes, **kwargs)`)"""
+        return {"top_n": top_n, "time_budget": time_budget}
+
+    def speculation_stats(self, name: str) -> "SpeculationStats":
+        """Outcome counters of speculative work of a workflow, kept for the process lifetime"""
+        with self._lock:
+            if name not in self._speculation_stats:
+                from libs.speculation import SpeculationStats
+
+                self._speculation_stats[name] = SpeculationStats()
+            return self._speculation_stats[name]
+
+    def index(
+        self,
+        collection_name: str,
+        vector_storage_uri: str,
+        embed_model: "BaseEmbedding",
+    ) -> "VectorStoreIndex":
+        """Return the index over `collection_name`, building it on the first request."""
+        key = (collection_name, vector_storage_uri, id(embed_model))
+        with self._lock:
+            if key in self._indexes:
+                self._indexes.move_to_end(key)
+                return self._indexes[key]
+
+        client = self.qdrant_client(vector_storage_uri)
+        aclient = self.async_qdrant_client(vector_storage_uri)
+
+        from llama_index.core import VectorStoreIndex
+        from llama_index.vector_stores.qdrant import QdrantVectorStore
+
+        # `aclient` backs `retriever.aretrieve`, so searches don't block the event loop
+        vector_store = QdrantVectorStore(
+            client=client, aclient=aclient, collection_name=collection_name
+        )
+        index = VectorStoreIndex.from_vector_store(
+            vector_store=vector_store, embed_model=embed_model
+        )
+
+        with self._lock:
+            self._indexes[key] = index
+            self._indexes.move_to_end(key)
+            while len(self._indexes) > self.index_cache_size:
+                self._indexes.popitem(last=False)
+        return index
+
+    @staticmethod
+    def llm_call_kwargs(
+        temperature: Optional[float] = None, max_tokens: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Call-time generation overrides for the shared LLM (`llm.complete(prompt, **kwargs)`)."""
+        generation_config: Dict[str, Any] = {}
+        if temperature is not None:
+            generation_config["temperature"] = temperature
+        if max_tokens is not None:
+            generation_config["max_output_tokens"] = max_tokens
+        return {"generation_config": generation_config} if generation_config else {}
+
+    async def close(self) -> None:
+        with self._lock:
+            clients = list(self._qdrant_clients.values())
+            async_clients = list(self._async_qdrant_clients.values())
+            crawl_readers = list(self._crawl_readers.values())
+            crawl_cache = self._crawl_cache
+            self._crawl_cache = None
+            embedding_caches = list(self._embedding_caches.values())
+            self._embedding_caches.clear()
+            self._indexes.clear()
+            self._qdrant_clients.clear()
+            self._async_qdrant_clients.clear()
+            self._crawl_readers.clear()
+            self._embeddings.clear()
+            self._query_embedding_cache = None
+            embedding_batchers = list(self._embedding_batchers.values())
+            self._embedding_batchers.clear()
+            routers = list(self._routers.values())
+            self._routers.clear()
+            web_search = self._web_search
+            self._web_search = None
+            self._semantic_cache = None
+            self._speculation_stats.clear()
+            # Limiter settings (`configure_limits`) stay, counters and waiters go
+            self._limiters.clear()
+            self._reranker = None
+            self._llms.clear()
+
+        for client in clients:
+            try:
+                client.close()
+            except Exception as error:
+                print(f"[ResourceRegistry.close] Exception: {error}")
+
+        for aclient in async_clients:
+            try:
+                await aclient.close()
+            except Exception as error:
+                print(f"[ResourceRegistry.close] Exception: {error}")
+
+        for embedding_batcher in embedding_batchers:
+            embedding_batcher.close()
+
+        for router in routers:
+            router.close()
+
+        if web_search is not None:
+            try:
+                await web_search.aclose()
+            except Exception as error:
+                print(f"[ResourceRegistry.close] Exception: {error}")
+
+        for crawl_reader in crawl_readers:
+            try:
+                await crawl_reader.aclose()
+            except Exception as error:
+                print(f"[ResourceRegistry.close] Exception: {error}")
+
+        if crawl_cache is not None:
+            crawl_cache.close()
+
+        for embedding_cache in embedding_caches:
+            try:
+                embedding_cache.flush()
+            except Exception as error:
+                print(f"[ResourceRegistry.close] Exception: {error}")
+
+
+resources = ResourceRegistry()
@@ -0,0 +1,291 @@
+from abc import ABC, abstractmethod
+import asyncio
+from collections import deque
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from typing import Deque, Dict, List, Optional, Sequence
+
+import numpy as np
+from llama_index.core.embeddings import BaseEmbedding
+
+
+"""
+==============================================
+    Local TASK / QUERY router
+==============================================
+"""
+
+# Seed examples for the TASK / QUERY split used by the design workflows. Verdicts
+# the LLM makes on real messages are appended to the router log and refine these.
+DEFAULT_ROUTER_EXAMPLES: Dict[str, List[str]] = {
+    "TASK": [
+        "Summarize our conversation",
+        "Make it shorter",
+        "Remove the last paragraph",
+        "Reorder the list alphabetically",
+        "Fix the typos in this text",
+        "Translate this to German",
+        "Rewrite this in a more formal tone",
+        "Turn these bullet points into a table",
+        "Suggest a title for this chat",
+        "Thanks, that's all",
+    ],
+    "QUERY": [
+        "What are the best practices for designing onboarding flows?",
+        "How do I choose a color palette for a dashboard?",
+        "Explain the difference between usability testing and A/B testing",
+        "Give me more examples of progressive disclosure",
+        "What is a good touch target size on mobile?",
+        "Write an article about accessibility in form design",
+        "Which metrics should I track to measure UX quality?",
+        "Expand on the second point with research findings",
+        "How should error messages be written?",
+        "Create a guide on designing empty states",
+    ],
+}
+
+logger = logging.getLogger(__name__)
+
+
+class RouterLogHandler(logging.handlers.RotatingFileHandler):
+    """Size-capped router log; runs on the writer thread, failures go to `logging`"""
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+    def handleError(self, record: logging.LogRecord) -> None:
+        logger.warning("Cannot write router log %s", self.baseFilename, exc_info=True)
+
+
+class RouterDecision:
+    label: str
+    confidence: float
+    source: str
+    confident: bool
+    embedding: Optional[List[float]]
+
+    def __init__(
+        self,
+        label: str,
+        confidence: float,
+        source: str,
+        confident: bool = True,
+        embedding: Optional[List[float]] = None,
+    ):
+        self.label = label
+        self.confidence = confidence
+        self.source = source
+        self.confident = confident
+        self.embedding = embedding
+
+    def as_payload(self) -> Dict[str, object]:
+        return {
+            "label": self.label,
+            "confidence": round(self.confidence, 4),
+            "source": self.source,
+        }
+
+
+class QueryRouter(ABC):
+    """Interface of local classifiers that can replace the TASK / QUERY LLM call.
+
+    `classify` always returns its best guess; callers only act on it when
+    `decision.confident` is set and fall back to the LLM otherwise (also when
+    `classify` raises). Disabled routers are not asked at all. `record` feeds
+    back labels decided elsewhere (by the LLM) as training data.
+    """
+
+    enabled: bool = True
+
+    @abstractmethod
+    async def classify(
+        self, text: str, embedding: Optional[List[float]] = None
+    ) -> RouterDecision: ...
+
+    @abstractmethod
+    def record(
+        self, text: str, label: str, embedding: Optional[List[float]] = None
+    ) -> None: ...
+
+
+class EmbeddingCentroidRouter(QueryRouter):
+    """Nearest-centroid classifier over query embeddings of labelled examples.
+
+    Confidence is the cosine margin between the closest and the second closest
+    label centroid. Examples are the seeds plus every verdict in the router log
+    (`log_path`, JSON lines), most recent `max_examples` of them; they are
+    embedded `fit_concurrency` at a time. After a failed fit, `classify` raises
+    without refitting for `fit_retry_interval` seconds.
+
+    Verdicts are written by a `QueueListener` thread, off the request path. The
+    log rotates at `log_max_bytes` and keeps one previous file.
+    """
+
+    embed_model: BaseEmbedding
+    examples: Dict[str, List[str]]
+    confidence_threshold: float
+    log_path: Optional[str]
+    max_examples: int
+    fit_concurrency: int
+    fit_retry_interval: float
+    log_max_bytes: int
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        examples: Dict[str, List[str]] = DEFAULT_ROUTER_EXAMPLES,
+        confidence_threshold: float = 0.08,
+        log_path: Optional[str] = None,
+        max_examples: int = 500,
+        enabled: bool = True,
+        fit_concurrency: int = 4,
+        fit_retry_interval: float = 60.0,
+        log_max_bytes: int = 1_000_000,
+    ):
+        self.embed_model = embed_model
+        self.examples = examples
+        self.confidence_threshold = confidence_threshold
+        self.log_path = log_path
+        self.max_examples = max_examples
+        self.enabled = enabled
+        self.fit_concurrency = fit_concurrency
+        self.fit_retry_interval = fit_retry_interval
+        self.log_max_bytes = log_max_bytes
+
+        self._labels: List[str] = sorted(examples.keys())
+        self._sums: Optional[np.ndarray] = None
+        self._counts: Optional[np.ndarray] = None
+        self._fit_lock = asyncio.Lock()
+        self._fit_failed_at: Optional[float] = None
+        self._log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        self._log_listener: Optional[logging.handlers.QueueListener] = None
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _logged_examples(self) -> List[Dict[str, str]]:
+        """Most recent verdicts of the rotated and the current log; blocking, run it in a thread"""
+        if not self.log_path:
+            return []
+        logged: Deque[Dict[str, str]] = deque(maxlen=self.max_examples)
+        for path in (self.log_path + ".1", self.log_path):
+            if not os.path.isfile(path):
+                continue
+            try:
+                with open(path, "r") as log_file:
+                    for line in log_file:
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        if record.get("label") in self._labels and record.get("text"):
+                            logged.append(record)
+            except OSError:
+                logger.warning("Cannot read router log %s", path, exc_info=True)
+        return list(logged)
+
+    async def fit(self) -> None:
+        """(Re)build label centroids from seed examples and the router log"""
+        async with self._fit_lock:
+            logged = await asyncio.to_thread(self._logged_examples)
+            labelled = [
+                (label, text) for label in self._labels for text in self.examples[label]
+            ] + [(record["label"], record["text"]) for record in logged]
+
+            # Bounded, so a long router log doesn't flood the embedding backend queue
+            semaphore = asyncio.Semaphore(self.fit_concurrency)
+
+            async def embed(text: str) -> List[float]:
+                async with semaphore:
+                    return await self.embed_model.aget_query_embedding(text)
+
+            try:
+                embeddings = await asyncio.gather(*[embed(text) for _, text in labelled])
+            except Exception:
+                self._fit_failed_at = time.monotonic()
+                raise
+            self._fit_failed_at = None
+
+            vectors = np.stack([self._normalize(embedding) for embedding in embeddings])
+            sums = np.zeros((len(self._labels), vectors.shape[1]), dtype=np.float32)
+            counts = np.zeros(len(self._labels), dtype=np.float32)
+            for (label, _), vector in zip(labelled, vectors):
+                idx = self._labels.index(label)
+                sums[idx] += vector
+                counts[idx] += 1
+            self._sums, self._counts = sums, counts
+
+    async def classify(
+        self, text: str, embedding: Optional[List[float]] = None
+    ) -> RouterDecision:
+        if self._sums is None or self._counts is None:
+            if (
+                self._fit_failed_at is not None
+                and time.monotonic() - self._fit_failed_at < self.fit_retry_interval
+            ):
+                raise RuntimeError("Router is not fitted, the last fit failed")
+            await self.fit()
+        assert self._sums is not None and self._counts is not None
+
+        if embedding is None:
+            embedding = await self.embed_model.aget_query_embedding(text)
+
+        centroids = self._sums / np.maximum(self._counts, 1)[:, None]
+        similarities = np.array(
+            [float(self._normalize(centroid) @ self._normalize(embedding)) for centroid in centroids]
+        )
+        ranking = np.argsort(-similarities)
+        margin = float(similarities[ranking[0]] - similarities[ranking[1]])
+
+        return RouterDecision(
+            label=self._labels[int(ranking[0])],
+            confidence=margin,
+            source="local",
+            confident=self.enabled and margin >= self.confidence_threshold,
+            embedding=embedding,
+        )
+
+    def record(
+        self, text: str, label: str, embedding: Optional[List[float]] = None
+    ) -> None:
+        if label not in self._labels:
+            return
+
+        if embedding is not None and self._sums is not None and self._counts is not None:
+            idx = self._labels.index(label)
+            self._sums[idx] += self._normalize(embedding)
+            self._counts[idx] += 1
+
+        if not self.log_path:
+            return
+        if self._log_listener is None:
+            handler = RouterLogHandler(
+                os.path.abspath(self.log_path),
+                maxBytes=self.log_max_bytes,
+                backupCount=1,
+                delay=True,
+            )
+            self._log_listener = logging.handlers.QueueListener(self._log_queue, handler)
+            self._log_listener.start()
+        self._log_queue.put_nowait(
+            logging.makeLogRecord(
+                {"msg": json.dumps({"text": text, "label": label, "ts": time.time()})}
+            )
+        )
+
+    def close(self) -> None:
+        """Write out queued verdicts and stop the writer thread"""
+        listener = self._log_listener
+        self._log_listener = None
+        if listener is not None:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
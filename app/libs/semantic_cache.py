@@ -0,0 +1,134 @@
+from collections import OrderedDict
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+"""
+==============================================
+    Semantic answer cache
+==============================================
+"""
+
+
+class CachedCompletion:
+    chunks: List[str]
+    sources: List[Dict[str, Any]]
+    created_at: float
+    similarity: float
+
+    def __init__(
+        self,
+        chunks: List[str],
+        sources: List[Dict[str, Any]],
+        created_at: float,
+        similarity: float = 1.0,
+    ):
+        self.chunks = chunks
+        self.sources = sources
+        self.created_at = created_at
+        self.similarity = similarity
+
+
+class SemanticAnswerCache:
+    """Completed answers keyed by a partition key and the query embedding.
+
+    The partition key holds everything besides the query the answer depends on
+    (collection, workflow, request options), see `semantic_cache_key` of the
+    workflow configs. A lookup returns the stored completion of the partition
+    whose query embedding is most similar (cosine) to the new one, if it clears
+    `threshold` and is younger than `ttl`. Each partition keeps at most
+    `max_entries` answers.
+    """
+
+    max_entries: int
+
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: Dict[
+            Tuple[str, ...], "OrderedDict[int, Tuple[np.ndarray, CachedCompletion]]"
+        ] = {}
+        self._next_id = 0
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self,
+        key: Tuple[str, ...],
+        embedding: Sequence[float],
+        threshold: float,
+        ttl: float,
+    ) -> Optional[CachedCompletion]:
+        vector = self._normalize(embedding)
+        expired_before = time.time() - ttl
+
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.misses += 1
+                return None
+
+            for entry_id in [
+                entry_id
+                for entry_id, (_, completion) in entries.items()
+                if completion.created_at <= expired_before
+            ]:
+                entries.pop(entry_id)
+
+            if not entries:
+                self.misses += 1
+                return None
+
+            entry_ids = list(entries.keys())
+            matrix = np.stack([entries[entry_id][0] for entry_id in entry_ids])
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            entries.move_to_end(entry_ids[best])
+            completion = entries[entry_ids[best]][1]
+            return CachedCompletion(
+                chunks=completion.chunks,
+                sources=completion.sources,
+                created_at=completion.created_at,
+                similarity=float(similarities[best]),
+            )
+
+    def store(
+        self,
+        key: Tuple[str, ...],
+        embedding: Sequence[float],
+        chunks: List[str],
+        sources: List[Dict[str, Any]],
+    ) -> None:
+        with self._lock:
+            entries = self._entries.setdefault(key, OrderedDict())
+            self._next_id += 1
+            entries[self._next_id] = (
+                self._normalize(embedding),
+                CachedCompletion(chunks=chunks, sources=sources, created_at=time.time()),
+            )
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": sum(len(entries) for entries in self._entries.values()),
+        }
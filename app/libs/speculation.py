@@ -0,0 +1,134 @@
+import asyncio
+import re
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Generic, Optional, Set, TypeVar
+
+
+"""
+==============================================
+    Speculative retrieval
+==============================================
+"""
+
+T = TypeVar("T")
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def query_similarity(first: str, second: str) -> float:
+    """Jaccard similarity of the lowercased word sets of two queries"""
+    first_words: Set[str] = set(_WORD_PATTERN.findall(first.lower()))
+    second_words: Set[str] = set(_WORD_PATTERN.findall(second.lower()))
+    if not first_words and not second_words:
+        return 1.0
+    return len(first_words & second_words) / len(first_words | second_words)
+
+
+class SpeculationStats:
+    """How often speculative work was launched, used, or thrown away.
+
+    `hidden_latency` sums the seconds of speculative work that finished (or was
+    already running) before its result was asked for, i.e. latency taken off the
+    critical path.
+    """
+
+    launched: int = 0
+    used: int = 0
+    rejected: int = 0
+    discarded: int = 0
+    failed: int = 0
+    hidden_latency: float = 0.0
+
+    def __init__(self):
+        self.launched = 0
+        self.used = 0
+        self.rejected = 0
+        self.discarded = 0
+        self.failed = 0
+        self.hidden_latency = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, outcome: str, hidden_latency: float = 0.0) -> None:
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.hidden_latency += hidden_latency
+
+    def stats(self) -> Dict[str, float]:
+        settled = self.used + self.rejected + self.discarded + self.failed
+        return {
+            "launched": self.launched,
+            "used": self.used,
+            "rejected": self.rejected,
+            "discarded": self.discarded,
+            "failed": self.failed,
+            "hit_rate": round(self.used / settled, 4) if settled else 0.0,
+            "hidden_latency": round(self.hidden_latency, 3),
+        }
+
+
+class SpeculativeTask(Generic[T]):
+    """Work started on a guess of its input, before the real input is known.
+
+    `take(query)` returns the result if the real query is close enough to the
+    guessed one (see `query_similarity`) and `None` otherwise, in which case the
+    caller runs the work itself. Every task settles exactly once in `stats`.
+    """
+
+    query: str
+    min_similarity: float
+    stats: SpeculationStats
+
+    def __init__(
+        self,
+        query: str,
+        run: Callable[[str], Awaitable[T]],
+        stats: SpeculationStats,
+        min_similarity: float = 0.5,
+    ):
+        self.query = query
+        self.min_similarity = min_similarity
+        self.stats = stats
+        self._started_at = time.monotonic()
+        self._finished_at: Optional[float] = None
+        self._settled = False
+        self._task: "asyncio.Task[T]" = asyncio.ensure_future(self._run(run, query))
+        stats.record("launched")
+
+    async def _run(self, run: Callable[[str], Awaitable[T]], query: str) -> T:
+        try:
+            return await run(query)
+        finally:
+            self._finished_at = time.monotonic()
+
+    def _settle(self, outcome: str, hidden_latency: float = 0.0) -> None:
+        if not self._settled:
+            self._settled = True
+            self.stats.record(outcome, hidden_latency)
+
+    async def take(self, query: str) -> Optional[T]:
+        if self._settled:
+            return None
+
+        if query_similarity(self.query, query) < self.min_similarity:
+            self.discard(outcome="rejected")
+            return None
+
+        asked_at = time.monotonic()
+        try:
+            result = await self._task
+        except Exception:
+            self._settle("failed")
+            return None
+
+        finished_at = self._finished_at or asked_at
+        self._settle("used", min(finished_at, asked_at) - self._started_at)
+        return result
+
+    def discard(self, outcome: str = "discarded") -> None:
+        if not self._task.done():
+            self._task.cancel()
+        elif not self._task.cancelled():
+            # Mark a failure as retrieved, nobody is going to await it
+            self._task.exception()
+        self._settle(outcome)
@@ -0,0 +1,89 @@
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+"""
+==============================================
+    Cold start measurement
+==============================================
+"""
+
+
+class ImportTimeReport:
+    """`python -X importtime` output of a fresh interpreter, grouped by top-level package"""
+
+    module: str
+    wall_time: float
+    packages: List[Tuple[str, float]]
+    roots: List[Tuple[str, float]]
+
+    def __init__(
+        self,
+        module: str,
+        wall_time: float,
+        packages: List[Tuple[str, float]],
+        roots: List[Tuple[str, float]],
+    ):
+        self.module = module
+        self.wall_time = wall_time
+        self.packages = packages
+        self.roots = roots
+
+    @classmethod
+    def measure(cls, module: str, cwd: Optional[str] = None) -> "ImportTimeReport":
+        """Import `module` in a new interpreter; `wall_time` includes interpreter startup"""
+        started_at = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=cwd,
+            capture_output=True,
+            text=True,
+            env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+        )
+        wall_time = time.perf_counter() - started_at
+        if result.returncode != 0:
+            errors = [
+                line
+                for line in result.stderr.splitlines()
+                if not line.startswith("import time:")
+            ]
+            raise RuntimeError(
+                f"Importing {module} failed: {errors[-1] if errors else ''}"
+            )
+
+        self_times: Dict[str, float] = {}
+        root_times: Dict[str, float] = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "[us]" in line:
+                continue
+            try:
+                self_us, cumulative_us, name = line[len("import time:") :].split("|")
+            except ValueError:
+                continue
+            package = name.strip().split(".")[0]
+            self_times[package] = self_times.get(package, 0.0) + int(self_us) / 1e6
+            # Imports made directly by `module` are not indented beyond one level
+            if len(name) - len(name.lstrip()) <= 3:
+                root_times[name.strip()] = int(cumulative_us) / 1e6
+
+        return cls(
+            module=module,
+            wall_time=wall_time,
+            packages=sorted(self_times.items(), key=lambda item: item[1], reverse=True),
+            roots=sorted(root_times.items(), key=lambda item: item[1], reverse=True),
+        )
+
+    def format(self, top: int = 20, budget: Optional[float] = None) -> str:
+        lines = [f"Cold start of `{self.module}`: {self.wall_time:.2f}s"]
+        if budget is not None:
+            verdict = "within" if self.wall_time <= budget else "OVER"
+            lines[0] += f" ({verdict} budget of {budget:.2f}s)"
+
+        lines += ["", "Slowest top-level imports (cumulative):"]
+        lines += [f"  {seconds:8.3f}s  {name}" for name, seconds in self.roots[:top]]
+        lines += ["", "Slowest packages (self time, all submodules):"]
+        lines += [f"  {seconds:8.3f}s  {name}" for name, seconds in self.packages[:top]]
+        return "\n".join(lines)
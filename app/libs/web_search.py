@@ -0,0 +1,116 @@
+import asyncio
+from collections import OrderedDict
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from libs.limits import BackendLimiter
+
+
+"""
+==============================================
+    Web search
+==============================================
+"""
+
+
+class WebSearchService:
+    """DuckDuckGo search run off the event loop, with a per-query TTL cache.
+
+    Concurrent searches for the same normalized query share one outbound request.
+    Outbound requests take a slot of the optional `limiter`.
+    """
+
+    ttl: float
+    max_entries: int
+    limiter: Optional[BackendLimiter]
+
+    hits: int = 0
+    misses: int = 0
+    deduplicated: int = 0
+
+    def __init__(
+        self,
+        ttl: float = 60 * 60,
+        max_entries: int = 1024,
+        limiter: Optional[BackendLimiter] = None,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.limiter = limiter
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self._tool: Optional[Any] = None
+        self._cache: "OrderedDict[Tuple[str, int], Tuple[float, List[Dict[str, str]]]]" = (
+            OrderedDict()
+        )
+        self._in_flight: Dict[Tuple[str, int], "asyncio.Task[List[Dict[str, str]]]"] = {}
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    def _search(self, query: str, max_results: int) -> List[Dict[str, str]]:
+        if self._tool is None:
+            from llama_index.tools.duckduckgo import DuckDuckGoSearchToolSpec
+
+            self._tool = DuckDuckGoSearchToolSpec()
+        return self._tool.duckduckgo_full_search(query=query, max_results=max_results)
+
+    async def _search_and_store(
+        self, key: Tuple[str, int], query: str, max_results: int
+    ) -> List[Dict[str, str]]:
+        try:
+            if self.limiter is None:
+                results = await asyncio.to_thread(self._search, query, max_results)
+            else:
+                async with self.limiter.slot():
+                    results = await asyncio.to_thread(self._search, query, max_results)
+            self._cache[key] = (time.monotonic() + self.ttl, results)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+            return results
+        finally:
+            self._in_flight.pop(key, None)
+
+    async def search(self, query: str, max_results: int = 5) -> List[Dict[str, str]]:
+        key = (self.normalize_query(query), max_results)
+
+        cached = self._cache.get(key)
+        if cached is not None:
+            expires_at, results = cached
+            if expires_at > time.monotonic():
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return results
+            self._cache.pop(key, None)
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.deduplicated += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._search_and_store(key, query, max_results))
+            self._in_flight[key] = task
+
+        # One caller giving up must not cancel the search for everybody else
+        return await asyncio.shield(task)
+
+    async def aclose(self) -> None:
+        """Cancel searches in flight and drop the cache and the search client"""
+        tasks = list(self._in_flight.values())
+        self._in_flight.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._cache.clear()
+        self._tool = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "deduplicated": self.deduplicated,
+            "entries": len(self._cache),
+        }
@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import dotenv
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+
+"""
+==============================================
+    Workflow `.env` configuration
+==============================================
+"""
+
+
+class WorkflowEnv(BaseModel):
+    """Typed contents of a workflow `.env` file"""
+
+    model_config = ConfigDict(populate_by_name=True, extra="ignore", frozen=True)
+
+    model_id: str = Field(alias="MODEL_ID")
+    api_key: str = Field(alias="API_KEY")
+    embedding_model: str = Field(alias="EMBEDDING_MODEL")
+    ollama_uri: str = Field(alias="OLLAMA_URI")
+    vector_storage_uri: str = Field(alias="VECTOR_STORAGE_URI")
+    collection_name: str = Field(alias="COLLECTION_NAME")
+
+    # Opt-in semantic answer cache, see `libs.semantic_cache`
+    semantic_cache_enabled: bool = Field(default=False, alias="SEMANTIC_CACHE_ENABLED")
+    semantic_cache_threshold: float = Field(
+        default=0.95, alias="SEMANTIC_CACHE_THRESHOLD"
+    )
+    semantic_cache_ttl: float = Field(default=60 * 60, alias="SEMANTIC_CACHE_TTL")
+
+    # Local TASK / QUERY classifier in front of the LLM, see `libs.router`
+    local_router_enabled: bool = Field(default=False, alias="LOCAL_ROUTER_ENABLED")
+    local_router_confidence: float = Field(
+        default=0.08, alias="LOCAL_ROUTER_CONFIDENCE"
+    )
+
+    # Vector retrieval on the raw message while the planner LLM calls run, see
+    # `libs.speculation`. Reused when the rewritten query is similar enough.
+    speculative_retrieval_enabled: bool = Field(
+        default=False, alias="SPECULATIVE_RETRIEVAL_ENABLED"
+    )
+    speculative_retrieval_similarity: float = Field(
+        default=0.5, alias="SPECULATIVE_RETRIEVAL_SIMILARITY"
+    )
+
+    # CPU reranking of retrieved nodes, see `libs.reranker`. The model is loaded
+    # at startup when enabled.
+    reranker_enabled: bool = Field(default=False, alias="RERANKER_ENABLED")
+    rerank_top_n: int = Field(default=8, alias="RERANK_TOP_N")
+    rerank_time_budget: float = Field(default=1.5, alias="RERANK_TIME_BUDGET")
+
+    # Retrieved context is packed into this many tokens at most (less when the
+    # model window minus max_tokens is smaller), see `libs.context_packer`
+    context_token_budget: int = Field(default=12000, alias="CONTEXT_TOKEN_BUDGET")
+    context_node_max_tokens: int = Field(default=1200, alias="CONTEXT_NODE_MAX_TOKENS")
+
+    # Comma-separated workflow ids that plan with one fused structured LLM call
+    # (classification, retrieval query and route) instead of three separate ones
+    fused_planner_workflows: str = Field(default="", alias="FUSED_PLANNER_WORKFLOWS")
+
+    def uses_fused_planner(self, workflow_id: Optional[str]) -> bool:
+        workflow_ids = [
+            item.strip() for item in self.fused_planner_workflows.split(",") if item.strip()
+        ]
+        return "*" in workflow_ids or (workflow_id or "") in workflow_ids
+
+
+class WorkflowEnvFile:
+    """`.env` of a workflow, validated once and re-read only when the file changes.
+
+    `get()` is called on the request path: it stats the file at most once per
+    `check_interval` seconds and never parses it unless the mtime moved. A broken
+    edit keeps the last good config in place; `reload()` re-reads unconditionally
+    and raises instead.
+    """
+
+    path: str
+    workflow: str
+    check_interval: float
+
+    def __init__(self, path: str, workflow: str, check_interval: float = 2.0):
+        self.path = path
+        self.workflow = workflow
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._env: Optional[WorkflowEnv] = None
+        self._mtime: Optional[float] = None
+        self._checked_at: float = 0.0
+
+    def _parse(self) -> WorkflowEnv:
+        if not os.path.isfile(self.path):
+            raise RuntimeError(
+                f"Workflow `.env` config not found [{self.workflow}, file {self.path}]"
+            )
+
+        values: Dict[str, Any] = dotenv.dotenv_values(self.path)
+        try:
+            return WorkflowEnv.model_validate(values)
+        except ValidationError as error:
+            missing = [
+                str(err["loc"][0]) for err in error.errors() if err["type"] == "missing"
+            ]
+            if missing:
+                raise RuntimeError(
+                    f"{', '.join(missing)} not provided in workflow `.env` config "
+                    f"[{self.workflow}, file {self.path}]"
+                ) from error
+            raise RuntimeError(
+                f"Invalid workflow `.env` config [{self.workflow}, file {self.path}]: {error}"
+            ) from error
+
+    def reload(self) -> WorkflowEnv:
+        with self._lock:
+            mtime = os.stat(self.path).st_mtime if os.path.isfile(self.path) else None
+            self._env = self._parse()
+            self._mtime = mtime
+            self._checked_at = time.monotonic()
+            return self._env
+
+    def load(self) -> WorkflowEnv:
+        """Load once, at startup. Raises if the config is missing or invalid."""
+        if self._env is None:
+            return self.reload()
+        return self._env
+
+    def get(self) -> WorkflowEnv:
+        if self._env is None:
+            return self.reload()
+
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return self._env
+
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                return self._env
+            if mtime == self._mtime:
+                return self._env
+
+            try:
+                self._env = self._parse()
+                self._mtime = mtime
+                print(f"[WorkflowEnvFile] Reloaded {self.workflow} config from {self.path}")
+            except RuntimeError as error:
+                print(f"[WorkflowEnvFile] Keeping previous {self.workflow} config: {error}")
+            return self._env
@@ -0,0 +1,192 @@
+import atexit
+import functools
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+import rich
+from rich.markup import render as render_markup
+
+from libs.metrics import metrics
+from libs.ws_frames import encode_json
+
+
+"""
+==============================================
+    Workflow step logging and timing
+==============================================
+"""
+
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+step_duration_histogram = metrics.histogram(
+    "workflow_step_duration_seconds", "Duration of workflow steps, by workflow and step"
+)
+step_errors_counter = metrics.counter(
+    "workflow_step_errors_total", "Workflow steps that raised, by workflow and step"
+)
+node_count_histogram = metrics.histogram(
+    "workflow_nodes",
+    "Nodes per retrieval stage (retrieved, deduplicated, filtered, packed), by workflow",
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+
+
+def timed_step(func: F) -> F:
+    """Record the duration of a workflow step; goes under `@step`"""
+
+    @functools.wraps(func)
+    async def timed(self: Any, *args: Any, **kwargs: Any) -> Any:
+        started_at = time.perf_counter()
+        try:
+            return await func(self, *args, **kwargs)
+        except Exception:
+            step_errors_counter.inc(workflow=type(self).__name__, step=func.__name__)
+            raise
+        finally:
+            step_duration_histogram.observe(
+                time.perf_counter() - started_at,
+                workflow=type(self).__name__,
+                step=func.__name__,
+            )
+
+    return timed  # type: ignore[return-value]
+
+
+def record_nodes(workflow: str, stage: str, count: int) -> None:
+    node_count_histogram.observe(count, workflow=workflow, stage=stage)
+
+
+class ConsoleHandler(logging.Handler):
+    """Human readable lines with rich markup, as the workflows used to print them"""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            fields = getattr(record, "fields", {})
+            timestamp = time.strftime("%H:%M:%S · %d.%m.%y", time.localtime(record.created))
+            content = " ".join(
+                [
+                    record.getMessage(),
+                    ("Next:[purple]" + fields["next"] + "[/]") if fields.get("next") else "",
+                ]
+            ).strip(" ")
+            runtime_meta = " executing ".join(
+                [fields.get("user", ""), fields.get("workflow", "")]
+            ).strip(" ")
+
+            rich.get_console().print(
+                f"[dim]{timestamp.ljust(32)}[/]"
+                f"[dim]{runtime_meta}[/]"
+                "\n"
+                f"[yellow]{(record.funcName + '():').ljust(32)}[/]"
+                f"{content}",
+                highlight=False,
+                crop=True,
+            )
+        except Exception:
+            self.handleError(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; rich markup is stripped from the message"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        try:
+            message = render_markup(message).plain
+        except Exception:
+            pass
+        return encode_json(
+            {
+                "ts": record.created,
+                "level": record.levelname.lower(),
+                "step": record.funcName,
+                "message": message,
+                **{
+                    key: value
+                    for key, value in getattr(record, "fields", {}).items()
+                    if value not in ("", None)
+                },
+            }
+        ).decode("utf-8")
+
+
+class WorkflowLogger:
+    """Structured log of workflow steps that stays off the request path.
+
+    `log` takes the step name from the caller's frame (`sys._getframe`, no
+    stack walk) and puts the record on a queue; a `QueueListener` thread
+    formats and writes it, as rich console lines (`text`) or JSON lines (`json`).
+    """
+
+    format: str
+    level: int
+
+    def __init__(self, name: str = "canvas.workflow", format: str = "text", level: int = logging.INFO):
+        self.format = format
+        self.level = level
+        self._logger = logging.getLogger(name)
+        self._logger.propagate = False
+        self._logger.setLevel(level)
+        self._queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def configure(self, format: Optional[str] = None, level: Optional[str] = None) -> None:
+        """`format` is `text` or `json`, `level` a logging level name; restarts the writer thread"""
+        if format is not None:
+            if format not in ("text", "json"):
+                raise ValueError(f"Unknown log format `{format}`, expected `text` or `json`")
+            self.format = format
+        if level is not None:
+            self.level = logging.getLevelName(level.upper())
+            if not isinstance(self.level, int):
+                raise ValueError(f"Unknown log level `{level}`")
+            self._logger.setLevel(self.level)
+        if self._listener is not None:
+            self.stop()
+            self.start()
+
+    def _handler(self) -> logging.Handler:
+        if self.format == "json":
+            handler: logging.Handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(JsonFormatter())
+            return handler
+        return ConsoleHandler()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._listener is not None:
+                return
+            if not self._logger.handlers:
+                self._logger.addHandler(logging.handlers.QueueHandler(self._queue))
+            self._listener = logging.handlers.QueueListener(self._queue, self._handler())
+            self._listener.start()
+
+    def stop(self) -> None:
+        """Write out queued records and stop the writer thread"""
+        with self._lock:
+            listener = self._listener
+            self._listener = None
+        if listener is not None:
+            listener.stop()
+
+    def log(self, message: str, level: int = logging.INFO, stacklevel: int = 1, **fields: Any) -> None:
+        if not self._logger.isEnabledFor(level):
+            return
+        if self._listener is None:
+            self.start()
+        step = sys._getframe(stacklevel).f_code.co_name
+        # `makeRecord` + `handle` skip `Logger.findCaller`, which walks the stack too
+        record = self._logger.makeRecord(
+            self._logger.name, level, "", 0, message, (), None, func=step, extra={"fields": fields}
+        )
+        self._logger.handle(record)
+
+
+workflow_logger = WorkflowLogger()
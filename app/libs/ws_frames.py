@@ -0,0 +1,172 @@
+import asyncio
+import json
+from typing import Any, Dict, List, Optional
+
+from fastapi import WebSocket
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None  # type: ignore[assignment]
+
+
+"""
+==============================================
+    Websocket output frames
+==============================================
+"""
+
+# Negotiated with `Sec-WebSocket-Protocol`; JSON text frames are the default
+BINARY_SUBPROTOCOL = "canvas.binary.v1"
+
+# First byte of a binary frame: a chunk frame carries raw UTF-8 text after it,
+# a tagged chunk frame one byte of request id length, the request id and the
+# text, any other frame carries its JSON encoding
+BINARY_JSON_FRAME = 0x00
+BINARY_CHUNK_FRAME = 0x01
+BINARY_TAGGED_CHUNK_FRAME = 0x02
+
+
+def encode_json(frame: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(frame, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(frame, default=str, ensure_ascii=False).encode("utf-8")
+
+
+class FrameWriter:
+    """Serializes outgoing frames of one websocket and coalesces completion chunks.
+
+    Deltas passed to `chunk` are buffered and sent as one `completion.chunk` frame
+    once `max_chars` are buffered or `window` seconds after the first buffered
+    delta. Any other frame flushes the buffer first, so frame order is kept.
+    Frames are plain dicts encoded with orjson (stdlib json when it is missing).
+
+    In a multiplexed session every request gets its own writer (`for_request`):
+    its frames carry `requestId` and it shares the socket send lock with the
+    session writer.
+    """
+
+    websocket: WebSocket
+    window: float
+    max_chars: int
+    binary: bool
+    request_id: Optional[str]
+
+    frames: int = 0
+    chunks: int = 0
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        window: float = 0.03,
+        max_chars: int = 512,
+        binary: bool = False,
+        request_id: Optional[str] = None,
+        lock: Optional[asyncio.Lock] = None,
+    ):
+        self.websocket = websocket
+        self.window = window
+        self.max_chars = max_chars
+        self.binary = binary
+        self.request_id = request_id
+        self.frames = 0
+        self.chunks = 0
+        self._buffer: List[str] = []
+        self._buffered = 0
+        self._timer: Optional["asyncio.Task[None]"] = None
+        self._lock = lock or asyncio.Lock()
+
+    @staticmethod
+    def negotiate(websocket: WebSocket) -> Optional[str]:
+        """Subprotocol to accept the connection with, if the client offered one we support"""
+        offered: List[str] = websocket.scope.get("subprotocols", [])
+        return BINARY_SUBPROTOCOL if BINARY_SUBPROTOCOL in offered else None
+
+    def for_request(self, request_id: str) -> "FrameWriter":
+        return FrameWriter(
+            self.websocket,
+            window=self.window,
+            max_chars=self.max_chars,
+            binary=self.binary,
+            request_id=request_id,
+            lock=self._lock,
+        )
+
+    async def _send_frame(self, frame: Dict[str, Any]) -> None:
+        self.frames += 1
+        is_chunk = frame["type"] == "completion.chunk" and frame.keys() == {"type", "content"}
+        if self.request_id is not None:
+            frame["requestId"] = self.request_id
+
+        if not self.binary:
+            await self.websocket.send_text(encode_json(frame).decode("utf-8"))
+        elif is_chunk and self.request_id is None:
+            await self.websocket.send_bytes(
+                bytes([BINARY_CHUNK_FRAME]) + str(frame["content"]).encode("utf-8")
+            )
+        elif is_chunk and len(self.request_id.encode("utf-8")) < 256:
+            request_id = self.request_id.encode("utf-8")
+            await self.websocket.send_bytes(
+                bytes([BINARY_TAGGED_CHUNK_FRAME, len(request_id)])
+                + request_id
+                + str(frame["content"]).encode("utf-8")
+            )
+        else:
+            await self.websocket.send_bytes(bytes([BINARY_JSON_FRAME]) + encode_json(frame))
+
+    async def send(
+        self,
+        type: str,
+        content: Optional[Any] = None,
+        payload: Optional[Any] = None,
+    ) -> None:
+        frame: Dict[str, Any] = {"type": type}
+        if content is not None:
+            frame["content"] = content
+        if payload is not None:
+            frame["payload"] = payload
+        async with self._lock:
+            await self._flush_buffer()
+            await self._send_frame(frame)
+
+    async def chunk(self, delta: str) -> None:
+        if not delta:
+            return
+        self.chunks += 1
+        self._buffer.append(delta)
+        self._buffered += len(delta)
+        if self._buffered >= self.max_chars or self.window <= 0:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception as error:
+            # The next `send` or `flush` on the request path surfaces the failure
+            print(f"[FrameWriter] Exception: {error}")
+
+    async def _flush_buffer(self) -> None:
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        content = "".join(self._buffer)
+        self._buffer.clear()
+        self._buffered = 0
+        await self._send_frame({"type": "completion.chunk", "content": content})
+
+    async def flush(self) -> None:
+        async with self._lock:
+            await self._flush_buffer()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "frames": self.frames,
+            "chunks": self.chunks,
+            "chunks_per_frame": round(self.chunks / self.frames, 2) if self.frames else 0.0,
+        }
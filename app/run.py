@@ -1,14 +1,76 @@
+import time
+
+startup_started_at = time.perf_counter()
+
+import argparse
+import os
+import sys
 import uvicorn
-import fastapi
 from dotenv import dotenv_values
 import rich
 from typing import Dict, Any, Optional
 
 env = dotenv_values(".env")
 env_keys = env.keys()
+
+"""
+Command line
+"""
+parser = argparse.ArgumentParser(description="RAG canvas API server")
+parser.add_argument(
+    "--import-report",
+    action="store_true",
+    help="Measure a cold start with `python -X importtime`, print the slowest imports and exit",
+)
+parser.add_argument(
+    "--startup-budget",
+    type=float,
+    default=float(env.get("STARTUP_BUDGET") or 5.0),
+    help="Cold start budget in seconds; `--import-report` exits with 1 when it is exceeded",
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.import_report:
+        from libs.startup import ImportTimeReport
+
+        # Before the app is imported here, so this process doesn't pay for it twice
+        try:
+            report = ImportTimeReport.measure(
+                "run", cwd=os.path.dirname(os.path.abspath(__file__))
+            )
+        except RuntimeError as error:
+            rich.print(f"[red]ERROR:[/] {error}")
+            sys.exit(2)
+        print(report.format(budget=args.startup_budget))
+        sys.exit(0 if report.wall_time <= args.startup_budget else 1)
+
 from apis.canvas import CanvasApi, API_OBSERVABILITY_SERVICE
+from libs.limits import parse_limits
+from libs.resources import resources
+from libs.workflow_log import workflow_logger
 from server_app import app
 
+"""
+Workflow logs: LOG_FORMAT=text|json, LOG_LEVEL=INFO
+"""
+workflow_logger.configure(
+    format=str(env.get("LOG_FORMAT") or "text"),
+    level=str(env.get("LOG_LEVEL") or "INFO"),
+)
+
+"""
+Backend concurrency limits and admission control, e.g.
+BACKEND_LIMITS=gemini=8,ollama=4,qdrant=16,crawl4ai=2,search=4,completions=32
+"""
+resources.configure_limits(
+    parse_limits(str(env.get("BACKEND_LIMITS") or "")),
+    max_queue=int(str(env["BACKEND_MAX_QUEUE"])) if env.get("BACKEND_MAX_QUEUE") else None,
+    queue_timeout=(
+        float(str(env["BACKEND_QUEUE_TIMEOUT"])) if env.get("BACKEND_QUEUE_TIMEOUT") else None
+    ),
+)
+
 """
 Init onbservability
 """
@@ -30,9 +92,24 @@ CanvasApi(
     prefix="/api/canvas",
     observability=API_OBSERVABILITY_SERVICE.LANGFUSE,
     observability_kwargs=observability_kwargs,
+    frame_window=(
+        float(str(env["FRAME_WINDOW_MS"])) / 1000 if env.get("FRAME_WINDOW_MS") else None
+    ),
+    frame_max_chars=(
+        int(str(env["FRAME_MAX_CHARS"])) if env.get("FRAME_MAX_CHARS") else None
+    ),
 )
 
+startup_time = time.perf_counter() - startup_started_at
+
 if __name__ == "__main__":
+    if startup_time > args.startup_budget:
+        rich.print(
+            f"[orange]WARNING:[/] Startup took {startup_time:.2f}s, over the {args.startup_budget:.2f}s budget. "
+            "Run with --import-report to see the slowest imports"
+        )
+    else:
+        rich.print(f"Started in {startup_time:.2f}s")
     host = env.get("HOST") or "0.0.0.0"
     port = int(str(env.get("PORT"))) or 8080
     rich.print(f"Starting server on {host}:{port}")
@@ -1,12 +1,42 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Callable, List
 from fastapi import FastAPI, Request
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 import rich
 
+from libs.metrics import metrics
+from libs.resources import resources
+from libs.workflow_log import workflow_logger
+
 rich.console = rich.console.Console(highlight=False)
 
-app = FastAPI()
+
+# Blocking warm-ups (model loads) registered by the APIs; run at server startup
+# in a worker thread, so importing the app stays cheap (`run.py --import-report`)
+startup_hooks: List[Callable[[], None]] = []
+
+
+def on_startup(hook: Callable[[], None]) -> None:
+    startup_hooks.append(hook)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for hook in startup_hooks:
+        try:
+            await asyncio.to_thread(hook)
+        except Exception as error:
+            print(f"[lifespan] Exception: {error}")
+    yield
+    # Shared LLM / embedding / vector store clients live as long as the server
+    await resources.close()
+    workflow_logger.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # ----------------------------------
 # Add middleware
@@ -24,3 +54,14 @@ app.add_middleware(
 # ----------------------------------
 # Add authorization checks
 # ----------------------------------
+
+# ----------------------------------
+# Metrics: step durations, backend latencies and queues, node counts
+# ----------------------------------
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -1,92 +1,152 @@
-from email import message
 from pydantic import BaseModel
 from schemas.canvas import ChatCompletionRequest, DefaultResponse
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Set, Tuple
 
-import dotenv
 from os import path
 
-import qdrant_client
-from llama_index.core import VectorStoreIndex
-from llama_index.vector_stores.qdrant import QdrantVectorStore
-from llama_index.core.llms import LLM
-from llama_index.core.embeddings import BaseEmbedding
-from llama_index.core.callbacks import LlamaDebugHandler, CallbackManager
-from llama_index.llms.ollama import Ollama
-from llama_index.llms.gemini import Gemini
-from llama_index.embeddings.ollama import OllamaEmbedding
-from llama_index.core.embeddings.utils import EmbedType
-from llama_index.core.base.base_retriever import BaseRetriever
-from llama_index.core.base.base_query_engine import BaseQueryEngine
-from llama_index.storage.docstore.mongodb import MongoDocumentStore
-from llama_index.core.storage.storage_context import StorageContext
+from libs.context_packer import context_token_budget
+from libs.resources import resources
+from libs.workflow_env import WorkflowEnv, WorkflowEnvFile
+
+
+env_file = WorkflowEnvFile(
+    path=path.dirname(__file__) + "/.env", workflow="DesignExpertWorkflow"
+)
+
+# Request fields left out of the semantic cache key: the query itself, context
+# that disqualifies a request from the cache, the collection (keyed by name) and
+# transport options. Every other field shapes the answer.
+SEMANTIC_CACHE_KEY_EXCLUDED_FIELDS: Set[str] = {
+    "message",
+    "chat_history",
+    "artifact",
+    "highlighted_text",
+    "knowledge",
+    "stream",
+}
 
 
 class DesignExpertWorkflowConfig(BaseModel):
 
+    @staticmethod
+    def load_env() -> WorkflowEnv:
+        """Read and validate the workflow `.env` once, at startup"""
+        return env_file.load()
+
+    @staticmethod
+    def warm_up() -> None:
+        """Load the resources the workflow config enables, so the first request doesn't pay for it"""
+        if env_file.get().reranker_enabled:
+            resources.reranker()
+
+    @staticmethod
+    def reload_env() -> WorkflowEnv:
+        return env_file.reload()
+
+    @staticmethod
+    def get_env() -> WorkflowEnv:
+        return env_file.get()
+
     @staticmethod
     def init_from_request(request: ChatCompletionRequest) -> Dict[str, Any]:
 
-        workflow_folder = path.dirname(__file__)
-        env: Dict[str, Any] = dotenv.dotenv_values(workflow_folder + "/.env")
-
-        for env_key in [
-            "MODEL_ID",
-            "API_KEY",
-            "EMBEDDING_MODEL",
-            "OLLAMA_URI",
-            "VECTOR_STORAGE_URI",
-            "COLLECTION_NAME",
-        ]:
-            if env_key not in env.keys():
-                raise RuntimeError(
-                    f"{env_key} not provided in workflow `.env` config [DesignExpertWorkflow]"
-                )
-
-        llm = Gemini(
-            model=env.get("MODEL_ID", ""),
-            api_key=env.get("API_KEY", ""),
-            temperature=request.temperature or 0.1,
-            max_tokens=request.max_tokens or 3600,
-        )
+        env = env_file.get()
 
-        client = qdrant_client.QdrantClient(url=env.get("VECTOR_STORAGE_URI", ""))
+        llm = resources.llm(model=env.model_id, api_key=env.api_key)
 
-        embed_model = OllamaEmbedding(
-            model_name=env.get("EMBEDDING_MODEL", ""),
-            base_url=env.get("OLLAMA_URI", ""),
+        embed_model = resources.embedding(
+            model_name=env.embedding_model,
+            base_url=env.ollama_uri,
             embed_batch_size=256,
         )
 
         # llama_debug = LlamaDebugHandler(print_trace_on_end=True)
         # Settings.callback_manager = CallbackManager([llama_debug])
 
-        collection_name = (
-            request.knowledge[0].id
-            if request.knowledge and len(request.knowledge) > 0
-            else env.get("COLLECTION_NAME", None)
-        )
+        collection_name = DesignExpertWorkflowConfig.collection_name(request, env)
 
         if not collection_name:
             raise RuntimeError("VectoreStore collection is not provided")
 
-        vector_store = QdrantVectorStore(client=client, collection_name=collection_name)
-        index = VectorStoreIndex.from_vector_store(
-            vector_store=vector_store, embed_model=embed_model
+        index = resources.index(
+            collection_name=collection_name,
+            vector_storage_uri=env.vector_storage_uri,
+            embed_model=embed_model,
         )
 
         return {
             "llm": llm,
             "embedding": embed_model,
             "index": index,
+            "router": resources.router(
+                name="DesignExpertWorkflow",
+                embed_model=embed_model,
+                enabled=env.local_router_enabled,
+                confidence_threshold=env.local_router_confidence,
+            ),
+            # Enabled by a reload, the model must not load on the event loop
+            "reranker": resources.reranker(load=False) if env.reranker_enabled else None,
+            "rerank_kwargs": resources.rerank_kwargs(
+                top_n=env.rerank_top_n, time_budget=env.rerank_time_budget
+            ),
+            "llm_kwargs": resources.llm_call_kwargs(
+                temperature=request.temperature or 0.1,
+                max_tokens=request.max_tokens or 3600,
+            ),
+            "context_kwargs": {
+                "budget": context_token_budget(
+                    context_window=llm.metadata.context_window,
+                    max_tokens=request.max_tokens or 3600,
+                    cap=env.context_token_budget,
+                ),
+                "max_node_tokens": env.context_node_max_tokens,
+            },
         }
 
+    @staticmethod
+    def collection_name(request: ChatCompletionRequest, env: WorkflowEnv) -> str:
+        return (
+            request.knowledge[0].id
+            if request.knowledge and len(request.knowledge) > 0
+            else env.collection_name
+        )
+
+    @staticmethod
+    def semantic_cache_key(request: ChatCompletionRequest) -> Optional[Tuple[str, ...]]:
+        """Semantic cache partition of the request, if it may be answered from the cache.
+
+        Only standalone questions qualify: no artifact, no highlighted text and no
+        chat history the answer could depend on. Every other request option
+        (web search, temperature, max tokens, artifact length, ...) and the
+        configured model are part of the key, so answers don't cross them.
+        """
+        env = env_file.get()
+        if not env.semantic_cache_enabled:
+            return None
+        if request.artifact or request.highlighted_text or request.chat_history:
+            return None
+        collection_name = DesignExpertWorkflowConfig.collection_name(request, env)
+        if not collection_name:
+            return None
+        options = request.model_dump(exclude=SEMANTIC_CACHE_KEY_EXCLUDED_FIELDS)
+        return (
+            collection_name,
+            f"env_model_id={env.model_id}",
+            *(f"{name}={value}" for name, value in sorted(options.items())),
+        )
+
     @staticmethod
     def run_from_request(request: ChatCompletionRequest) -> Dict[str, Any]:
+        env = env_file.get()
         return {
             "message": request.message,
             "chat_history": request.chat_history,
             "artifact": request.artifact,
             "highlighted_text": request.highlighted_text,
             "web_search_enabled": request.web_search_enabled,
+            "planner": (
+                "fused" if env.uses_fused_planner(request.workflow_id) else "multi_step"
+            ),
+            "speculative_retrieval": env.speculative_retrieval_enabled,
+            "speculative_retrieval_similarity": env.speculative_retrieval_similarity,
         }
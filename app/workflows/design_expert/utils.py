@@ -1,9 +1,8 @@
-import datetime
-import inspect
 from pygments import highlight
-import rich
 from llama_index.core.schema import NodeWithScore
-from typing import List, TypeVar
+from typing import Any, List, TypeVar
+
+from libs.workflow_log import workflow_logger
 
 T = TypeVar("T")
 
@@ -14,31 +13,12 @@ def log(
     user: str = "",
     truncate: bool = True,
     next: str = "",
-    **kwargs,
+    **fields: Any,
 ) -> None:
-    TRUNCATE_LEN = 56
-    _stack = inspect.stack()
-    step_name = _stack[1][3]
-
-    timestamp = datetime.datetime.now().strftime("%H:%M:%S · %d.%m.%y")
-
-    _content = " ".join(
-        [
-            content,
-            ("Next:[purple]" + next + "[/]") if next else "",
-        ]
-    ).strip(" ")
-
-    _runtime_meta = " executing ".join([user, workflow]).strip(" ")
-
-    log_str = (
-        f"[dim]{timestamp.ljust(32)}[/]"
-        f"[dim]{_runtime_meta}[/]"
-        "\n"
-        f"[yellow]{(step_name+'():').ljust(32)}[/]"
-        f"{_content}"
+    """Log line of the calling step; extra keyword arguments are kept as structured fields"""
+    workflow_logger.log(
+        content, stacklevel=2, workflow=workflow, user=user, next=next, **fields
     )
-    rich.get_console().print(log_str, highlight=False, crop=True)
 
 
 def format_nodes(nodes: List[NodeWithScore]) -> str:
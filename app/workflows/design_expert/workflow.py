@@ -17,7 +17,6 @@ from llama_index.core.workflow import (
     Context,
 )
 from llama_index.core.postprocessor import SimilarityPostprocessor, LongContextReorder
-from llama_index.postprocessor.colbert_rerank import ColbertRerank
 from llama_index.core.llms import ChatMessage, LLM
 from llama_index.core.postprocessor import LongContextReorder
 from llama_index.core.base.llms.types import (
@@ -25,22 +24,25 @@ from llama_index.core.base.llms.types import (
     CompletionResponseGen,
     CompletionResponseAsyncGen,
 )
-from llama_index.core.schema import NodeWithScore
-from llama_index.tools.duckduckgo import DuckDuckGoSearchToolSpec
+from llama_index.core.schema import NodeWithScore, QueryBundle
 from llama_index.core.embeddings.utils import EmbedType
-from llama_index.core.schema import NodeWithScore
 from llama_index.core import Settings
 from llama_index.core import VectorStoreIndex
-from openinference.instrumentation.llama_index import LlamaIndexInstrumentor
-import json_repair.json_parser
-from networkx import nodes
 from pydantic import BaseModel, Field, PrivateAttr
 from typing import Generator, Literal, Optional, Union
 
 from typing import List, Any, Dict
 
 from schemas.canvas import Artifact, shortuuid
+from libs.context_packer import pack_nodes
 from libs.crawl4ai import Crawl4AiReader, string_metadata_dict
+from libs.ephemeral_index import EphemeralVectorRetriever
+from libs.node_dedup import DeduplicateNodesPostprocessor
+from libs.reranker import RerankerService
+from libs.resources import resources
+from libs.router import QueryRouter, RouterDecision
+from libs.speculation import SpeculativeTask
+from libs.workflow_log import record_nodes, timed_step
 
 from .utils import format_nodes, last_n, log
 
@@ -62,11 +64,23 @@ class DetermineContextNeeds(Event):
     pass
 
 
+class PlanRequest(Event):
+    pass
+
+
 class GeneratePath(Event):
     nodes: List[NodeWithScore] = []
     pass
 
 
+class SelectRoute(Event):
+    pass
+
+
+class RouteSelected(Event):
+    route: str
+
+
 class RewriteQueryForRetrieval(Event):
     pass
 
@@ -100,13 +114,19 @@ class RespondToQuery(Event):
     nodes: List[NodeWithScore]
 
 
+class ArtifactRoute(str, Enum):
+    generateArtifact = "generateArtifact"
+    replyToGeneralInput = "replyToGeneralInput"
+    rewriteArtifact = "rewriteArtifact"
+
+
 class WorkflowResult:
-    async_response_gen: CompletionResponseGen
+    async_response_gen: CompletionResponseAsyncGen
     nodes: List[NodeWithScore]
 
     def __init__(
         self,
-        async_response_gen: CompletionResponseGen,
+        async_response_gen: CompletionResponseAsyncGen,
         nodes: List[NodeWithScore] = [],
     ):
         self.async_response_gen = async_response_gen
@@ -121,13 +141,20 @@ Design Expert workflow
 class DesignExpertWorkflow(Workflow):
 
     llm: LLM
+    llm_kwargs: Dict[str, Any]
     embedding: EmbedType
     index: VectorStoreIndex
+    router: Optional[QueryRouter]
+    reranker: Optional[RerankerService]
+    rerank_kwargs: Dict[str, Any]
+    context_kwargs: Dict[str, Any]
 
     _log_defaults: Dict[str, Any] = {}
 
     DOCUMENTS_PER_SEARCH = 5
     SEARCH_RESULTS_TOP_K = 10
+    # Pages not crawled within this many seconds are dropped from the search results
+    CRAWL_TIMEOUT = 20
 
     RETRIEVE_TOP_K = 20
 
@@ -138,18 +165,29 @@ class DesignExpertWorkflow(Workflow):
         llm: LLM,
         embedding: EmbedType,
         index: VectorStoreIndex,
+        llm_kwargs: Optional[Dict[str, Any]] = None,
+        router: Optional[QueryRouter] = None,
+        reranker: Optional[RerankerService] = None,
+        rerank_kwargs: Optional[Dict[str, Any]] = None,
+        context_kwargs: Optional[Dict[str, Any]] = None,
         **kwargs: Any,
     ):
         super().__init__(**kwargs)
         self.llm = llm
+        self.llm_kwargs = llm_kwargs or {}
         self.embedding = embedding
         self.index = index
+        self.router = router
+        self.reranker = reranker
+        self.rerank_kwargs = rerank_kwargs or {}
+        self.context_kwargs = context_kwargs or {}
         pass
 
     @step
+    @timed_step
     async def start(
         self, ctx: Context, ev: StartEvent
-    ) -> DetermineContextNeeds | GeneratePath:
+    ) -> DetermineContextNeeds | PlanRequest | GeneratePath | SelectRoute:
         """Parse and serialize workflow inputs. Add them to the context."""
 
         self._log_defaults = {"workflow": "DesignExpertWorkflow", "user": "Eugene"}
@@ -162,6 +200,8 @@ class DesignExpertWorkflow(Workflow):
             raise RuntimeError("Message is empty")
 
         await ctx.set("original_user_message", original_user_message)
+        # Set when the caller has already embedded the message (semantic cache lookup)
+        await ctx.set("message_embedding", ev.get("query_embedding", None))
 
         artifact: Artifact | None = ev.get("artifact", None)
         await ctx.set("artifact", artifact.content if artifact is not None else None)
@@ -173,6 +213,21 @@ class DesignExpertWorkflow(Workflow):
         web_search_enabled = ev.get("web_search_enabled", False)
         await ctx.set("web_search_enabled", web_search_enabled)
 
+        planner = ev.get("planner", "multi_step")
+
+        await ctx.set("speculative_retrieval", None)
+        if self.index and ev.get("speculative_retrieval", False):
+            # Retrieve for the raw message while the planner works out the real query
+            await ctx.set(
+                "speculative_retrieval",
+                SpeculativeTask(
+                    query=original_user_message,
+                    run=self._retrieve_from_index,
+                    stats=resources.speculation_stats("DesignExpertWorkflow"),
+                    min_similarity=ev.get("speculative_retrieval_similarity", 0.5),
+                ),
+            )
+
         if not self.index:
             ctx.write_event_to_stream(
                 ProgressEvent(
@@ -180,15 +235,88 @@ class DesignExpertWorkflow(Workflow):
                 )
             )
             log("No index provided", next="GeneratePath", **self._log_defaults)
+            self._dispatch_route_selection(ctx)
             return GeneratePath(nodes=[])
+        elif planner == "fused":
+            log("", next="PlanRequest", **self._log_defaults)
+            return PlanRequest()
         else:
             log("", next="DetermineContextNeeds", **self._log_defaults)
             return DetermineContextNeeds()
 
     @step
+    @timed_step
+    async def plan(
+        self, ctx: Context, ev: PlanRequest
+    ) -> DetermineContextNeeds | GeneratePath | SelectRoute | None:
+        """Fused planner: context needs, retrieval query and route in one structured completion.
+        Falls back to the multi-step path if the completion cannot be parsed."""
+        user_query = await ctx.get("original_user_message")
+        highlighted_text = await ctx.get("highlighted_text")
+        artifact = await ctx.get("artifact")
+        chat_history: List[Any] = await ctx.get("chat_history")
+        web_search_enabled: bool = await ctx.get("web_search_enabled", False)
+
+        prompt = prompts.FUSED_PLAN_PROMPT.format(
+            app_context=prompts.APP_CONTEXT_SNIPPET,
+            artifact=self._artifact_snippet(artifact),
+            highlighted_text=self._highlighted_text_snippet(highlighted_text),
+            recent_messages=self._recent_messages_snippet(chat_history),
+            route_options=(
+                prompts.HAS_ARTIFACT_ROUTES if artifact else prompts.NO_ARTIFACT_ROUTES
+            ),
+            user_query=user_query,
+        )
+
+        class _Plan(BaseModel):
+            needs_context: bool
+            retrieval_query: str = ""
+            route: ArtifactRoute
+
+        try:
+            structured_llm = self.llm.as_structured_llm(output_cls=_Plan)
+            async with resources.limiter("gemini").slot():
+                response = await structured_llm.acomplete(prompt, **self.llm_kwargs)
+            response_object: _Plan = _Plan.model_validate_json(json_data=response.text)
+        except Exception as error:
+            log(
+                f"[bold cyan]WARNING:[/] Fused planner failed: {str(error)}",
+                next="DetermineContextNeeds",
+                **self._log_defaults,
+            )
+            return DetermineContextNeeds()
+
+        log(response.text, **self._log_defaults)
+        await ctx.set("planned_route", response_object.route.value)
+
+        needs_context = (
+            response_object.needs_context and response_object.retrieval_query.strip()
+        )
+        ctx.write_event_to_stream(
+            ProgressEvent(
+                description=(
+                    f"Querying knowledge graph {'and search results' if web_search_enabled == True else ''}"
+                    if needs_context
+                    else "Analyzing need for knowledge graph query"
+                ),
+                content=response_object.retrieval_query if needs_context else "TASK",
+                payload={"plan": response_object.model_dump(mode="json")},
+            )
+        )
+
+        if needs_context:
+            await self._dispatch_retrieval(ctx, response_object.retrieval_query)
+            return None
+
+        log("", next="GeneratePath", **self._log_defaults)
+        self._dispatch_route_selection(ctx)
+        return GeneratePath(nodes=[])
+
+    @step
+    @timed_step
     async def determine_context_needs(
         self, ctx: Context, ev: DetermineContextNeeds
-    ) -> GeneratePath | RewriteQueryForRetrieval:
+    ) -> GeneratePath | SelectRoute | RewriteQueryForRetrieval:
 
         user_query = await ctx.get("original_user_message")
         app_context = prompts.APP_CONTEXT_SNIPPET
@@ -222,12 +350,39 @@ class DesignExpertWorkflow(Workflow):
             artifact=artifact_snippet,
         )
 
-        response = self.llm.complete(prompt)
-        verdict = response.text.strip().upper()
+        # ———————————————————————————————————————————————
+        # Local router answers when it is confident, LLM decides the rest:
+        decision: Optional[RouterDecision] = None
+        if self.router is not None and self.router.enabled:
+            try:
+                decision = await self.router.classify(
+                    user_query, embedding=await self._message_embedding(ctx)
+                )
+            except Exception as error:
+                log(
+                    f"[bold cyan]WARNING:[/] Local router failed, asking LLM: {str(error)}",
+                    **self._log_defaults,
+                )
+
+        if decision is not None and decision.confident:
+            verdict = decision.label
+        else:
+            async with resources.limiter("gemini").slot():
+                response = await self.llm.acomplete(prompt, **self.llm_kwargs)
+            verdict = response.text.strip().upper()
+            if self.router is not None:
+                self.router.record(
+                    user_query,
+                    verdict,
+                    embedding=decision.embedding if decision is not None else None,
+                )
+            decision = RouterDecision(label=verdict, confidence=1.0, source="llm")
 
         ctx.write_event_to_stream(
             ProgressEvent(
-                description="Analyzing need for knowledge graph query", content=verdict
+                description="Analyzing need for knowledge graph query",
+                content=verdict,
+                payload={"router": decision.as_payload()},
             )
         )
 
@@ -240,6 +395,7 @@ class DesignExpertWorkflow(Workflow):
             return RewriteQueryForRetrieval()
         elif verdict == "TASK":
             log(f"Returned '{verdict}'", next="GeneratePath", **self._log_defaults)
+            self._dispatch_route_selection(ctx)
             return GeneratePath(nodes=[])
         else:
             log(
@@ -249,9 +405,10 @@ class DesignExpertWorkflow(Workflow):
             return RewriteQueryForRetrieval()
 
     @step
+    @timed_step
     async def rewrite_query_for_retrieval(
         self, ctx: Context, ev: RewriteQueryForRetrieval
-    ) -> QuerySearchResults | QueryVectorIndex | None:
+    ) -> QuerySearchResults | QueryVectorIndex | SelectRoute | None:
         user_query = await ctx.get("original_user_message", "")
         app_context = prompts.APP_CONTEXT_SNIPPET
         highlighted_text = await ctx.get("highlighted_text", "")
@@ -288,7 +445,8 @@ class DesignExpertWorkflow(Workflow):
 
         structured_llm = self.llm.as_structured_llm(output_cls=_NewQuery)
 
-        response = structured_llm.complete(prompt)
+        async with resources.limiter("gemini").slot():
+            response = await structured_llm.acomplete(prompt, **self.llm_kwargs)
 
         response_object: _NewQuery = _NewQuery.model_validate_json(
             json_data=response.text
@@ -303,6 +461,14 @@ class DesignExpertWorkflow(Workflow):
             )
         )
 
+        await self._dispatch_retrieval(ctx, response_object.query)
+
+        return None
+
+    async def _dispatch_retrieval(self, ctx: Context, search_query: str) -> None:
+        """Start retrieval threads; `postprocess_nodes` waits for all of them"""
+        web_search_enabled: bool = await ctx.get("web_search_enabled", False)
+
         retrieval_threads = 1
         if web_search_enabled == True:
             retrieval_threads = retrieval_threads * 2
@@ -310,13 +476,83 @@ class DesignExpertWorkflow(Workflow):
         await ctx.set("retrieval_threads", retrieval_threads)
         await ctx.set("retrieval_threads_completed", 0)
 
-        ctx.send_event(QueryVectorIndex(search_query=response_object.query))
+        ctx.send_event(QueryVectorIndex(search_query=search_query))
         if web_search_enabled == True:
-            ctx.send_event(QuerySearchResults(search_query=response_object.query))
+            ctx.send_event(QuerySearchResults(search_query=search_query))
 
-        return None
+        # Routing only needs the message, artifact and history: run it alongside retrieval
+        self._dispatch_route_selection(ctx)
+
+    def _dispatch_route_selection(self, ctx: Context) -> None:
+        """`generate_path` joins the route with the retrieved nodes"""
+        ctx.send_event(SelectRoute())
+
+    def _artifact_snippet(self, artifact: Optional[str]) -> str:
+        if artifact:
+            return prompts.ARTIFACT_SNIPPET.format(artifact_content=str(artifact))
+        return prompts.NO_ARTIFACT_SNIPPET
+
+    def _highlighted_text_snippet(self, highlighted_text: Any) -> str:
+        if highlighted_text:
+            return prompts.HIGHLIGHTED_TEXT_SNIPPET.format(
+                highlighted_text=highlighted_text
+            )
+        return prompts.NO_HIGHLIGHTED_TEXT_SNIPPET
+
+    async def _message_embedding(self, ctx: Context) -> List[float]:
+        """Query embedding of the original message, computed once per run"""
+        embedding = await ctx.get("message_embedding", None)
+        if embedding is None:
+            original_user_message = await ctx.get("original_user_message")
+            embedding = await self.embedding.aget_query_embedding(original_user_message)
+            await ctx.set("message_embedding", embedding)
+        return embedding
+
+    def _recent_messages_snippet(self, chat_history: List[Any]) -> str:
+        if not chat_history:
+            return prompts.NO_RECENT_MESSAGES
+        recent_messages_acc: str = ""
+        for message in last_n(list(chat_history), 3):
+            recent_messages_acc += str(message)
+        return prompts.RECENT_MESSAGES_SNIPPET.format(
+            recent_messages=recent_messages_acc
+        )
+
+    async def _retrieve_from_index(self, search_query: str) -> List[NodeWithScore]:
+        retriever = self.index.as_retriever(similarity_top_k=self.RETRIEVE_TOP_K)
+        # Embedded before taking the qdrant slot, which then only covers the search
+        embedding = await self.embedding.aget_query_embedding(search_query)
+        async with resources.limiter("qdrant").slot():
+            return await retriever.aretrieve(
+                QueryBundle(query_str=search_query, embedding=embedding)
+            )
+
+    async def _settle_speculative_retrieval(
+        self, ctx: Context, search_query: Optional[str] = None
+    ) -> Optional[List[NodeWithScore]]:
+        """Result of the speculative retrieval if it applies to `search_query`; discards it otherwise"""
+        speculation: Optional[SpeculativeTask] = await ctx.get(
+            "speculative_retrieval", None
+        )
+        if speculation is None:
+            return None
+        await ctx.set("speculative_retrieval", None)
+
+        if search_query is None:
+            speculation.discard()
+            result_nodes = None
+        else:
+            result_nodes = await speculation.take(search_query)
+
+        log(
+            f"speculative retrieval {'used' if result_nodes is not None else 'dropped'}, "
+            f"stats: {speculation.stats.stats()}",
+            **self._log_defaults,
+        )
+        return result_nodes
 
     @step(num_workers=3)
+    @timed_step
     async def query_vector_index(
         self, ctx: Context, ev: QueryVectorIndex
     ) -> PostprocessNodes:
@@ -328,8 +564,13 @@ class DesignExpertWorkflow(Workflow):
 
         try:
             log(f"query={search_query}", **self._log_defaults)
-            retriever = self.index.as_retriever(similarity_top_k=self.RETRIEVE_TOP_K)
-            result_nodes: List[NodeWithScore] = retriever.retrieve(search_query)
+            speculative_nodes = await self._settle_speculative_retrieval(
+                ctx, search_query
+            )
+            if speculative_nodes is not None:
+                result_nodes = speculative_nodes
+            else:
+                result_nodes = await self._retrieve_from_index(search_query)
             log(
                 f"returned {len(result_nodes)} nodes for '{search_query}'",
                 **self._log_defaults,
@@ -350,6 +591,7 @@ class DesignExpertWorkflow(Workflow):
             return PostprocessNodes(nodes=result_nodes, query=ev.search_query)
 
     @step(num_workers=3)
+    @timed_step
     async def query_search_results(
         self, ctx: Context, ev: QuerySearchResults
     ) -> PostprocessNodes:
@@ -359,21 +601,26 @@ class DesignExpertWorkflow(Workflow):
         log(f"started search results query for '{search_query}'", **self._log_defaults)
         result_nodes: List[NodeWithScore] = []
         try:
-            search_results = DuckDuckGoSearchToolSpec().duckduckgo_full_search(
+            search_results = await resources.web_search().search(
                 query=search_query, max_results=self.DOCUMENTS_PER_SEARCH
             )
-            crawl_reader = Crawl4AiReader()
-            documents = await crawl_reader.read_markdown_documents(
-                urls=[source["href"] for source in search_results]
-            )
+            crawl_reader = resources.crawl_reader()
+            documents = [
+                document
+                async for document in crawl_reader.stream_markdown_documents(
+                    urls=[source["href"] for source in search_results],
+                    timeout=self.CRAWL_TIMEOUT,
+                )
+            ]
             log(f"crawled {len(documents)} documents", **self._log_defaults)
-            index = VectorStoreIndex.from_documents(
-                documents, show_progress=False, embed_model=self.embedding
+            retriever = await EphemeralVectorRetriever.afrom_documents(
+                documents,
+                embed_model=self.embedding,
+                similarity_top_k=self.SEARCH_RESULTS_TOP_K,
             )
-            retriever = index.as_retriever(
-                verbose=False, similarity_top_k=self.SEARCH_RESULTS_TOP_K
+            result_nodes: List[NodeWithScore] = await retriever.aretrieve(
+                original_user_query, query_embedding=await self._message_embedding(ctx)
             )
-            result_nodes: List[NodeWithScore] = retriever.retrieve(original_user_query)
             log(f"dispatched {len(result_nodes)} nodes", **self._log_defaults)
 
         except Exception as error:
@@ -391,6 +638,7 @@ class DesignExpertWorkflow(Workflow):
             return PostprocessNodes(nodes=result_nodes, query=ev.search_query)
 
     @step
+    @timed_step
     async def postprocess_nodes(
         self, ctx: Context, ev: PostprocessNodes
     ) -> GeneratePath | None:
@@ -419,10 +667,31 @@ class DesignExpertWorkflow(Workflow):
         retrieval_query = ev.query
         original_user_query = await ctx.get("original_user_message")
 
+        dedup_postprocessor = DeduplicateNodesPostprocessor()
+        nodes_unique = dedup_postprocessor.postprocess_nodes(all_nodes)
+        log(
+            f"Removed {len(all_nodes) - len(nodes_unique)} duplicate nodes",
+            **self._log_defaults,
+        )
+        record_nodes(type(self).__name__, "retrieved", len(all_nodes))
+        record_nodes(type(self).__name__, "deduplicated", len(nodes_unique))
+
         similarity_cutoff_postprocessor = SimilarityPostprocessor(
             similarity_cutoff=self.POSTPROCESSING_SIMILARITY_CUTOFF
         )
-        nodes_cutoff = similarity_cutoff_postprocessor.postprocess_nodes(all_nodes)
+        nodes_cutoff = similarity_cutoff_postprocessor.postprocess_nodes(nodes_unique)
+
+        if self.reranker is not None:
+            nodes_cutoff = await self.reranker.rerank(
+                original_user_query, nodes_cutoff, **self.rerank_kwargs
+            )
+            log(f"Reranked to {len(nodes_cutoff)} nodes", **self._log_defaults)
+        record_nodes(type(self).__name__, "filtered", len(nodes_cutoff))
+
+        if self.context_kwargs:
+            packed_context = pack_nodes(nodes_cutoff, **self.context_kwargs)
+            nodes_cutoff = packed_context.nodes
+            log(f"Context packed: {packed_context.report()}", **self._log_defaults)
 
         long_context_reorder_postprocessor = LongContextReorder()
         nodes_reordered = long_context_reorder_postprocessor.postprocess_nodes(
@@ -433,61 +702,92 @@ class DesignExpertWorkflow(Workflow):
             f"Postprocessing ended: {len(nodes_reordered)}/{len(all_nodes)} returned",
             **self._log_defaults,
         )
+        record_nodes(type(self).__name__, "packed", len(nodes_reordered))
 
         return GeneratePath(nodes=nodes_reordered)
 
     @step
+    @timed_step
+    async def select_route(self, ctx: Context, ev: SelectRoute) -> RouteSelected:
+        # The fused planner has already picked a route
+        route: Optional[str] = await ctx.get("planned_route", None)
+        if route is None:
+            route = await self._select_route(
+                user_query=await ctx.get("original_user_message"),
+                artifact=await ctx.get("artifact"),
+                chat_history=await ctx.get("chat_history"),
+                app_context=prompts.APP_CONTEXT_SNIPPET,
+            )
+        return RouteSelected(route=route)
+
+    @step
+    @timed_step
     async def generate_path(
-        self, ctx: Context, ev: GeneratePath
-    ) -> GenerateArtifact | UpdateArtifact | RewriteArtifact | RespondToQuery:
-        user_query = await ctx.get("original_user_message")
-        app_context = prompts.APP_CONTEXT_SNIPPET
-        artifact = await ctx.get("artifact")
+        self, ctx: Context, ev: GeneratePath | RouteSelected
+    ) -> GenerateArtifact | UpdateArtifact | RewriteArtifact | RespondToQuery | None:
+        """Join the selected route with the retrieved nodes"""
+        event_results = ctx.collect_events(ev, [GeneratePath, RouteSelected])
+        if event_results is None:
+            return None
+
+        path_event, route_event = event_results
+        nodes: List[NodeWithScore] = path_event.nodes
+        route = route_event.route
         highlighted_text = await ctx.get("highlighted_text")
-        chat_history: List[Any] = await ctx.get("chat_history")
 
-        # @TODO: Update artifact:
+        # No retrieval was needed after all
+        await self._settle_speculative_retrieval(ctx)
+
+        # One generation branch per run: every branch holds a gemini slot until
+        # its stream is consumed, and only the first StopEvent is ever read
         if highlighted_text:
-            ctx.send_event(UpdateArtifact(nodes=ev.nodes))
+            log(f"", next="UpdateArtifact", **self._log_defaults)
+            return UpdateArtifact(nodes=nodes)
 
-        if len(chat_history):
-            recent_messages_acc: str = ""
-            for message in last_n(chat_history, 3):
-                recent_messages_acc += str(message)
-            recent_messages_snippet = prompts.RECENT_MESSAGES_SNIPPET.format(
-                recent_mesages=recent_messages_acc
-            )
-        else:
-            recent_messages_snippet = prompts.NO_RECENT_MESSAGES
+        elif route == "generateArtifact":
+            log(f"", next="GenerateArtifact", **self._log_defaults)
+            return GenerateArtifact(nodes=nodes)
+
+        elif route == "rewriteArtifact":
+            log(f"", next="RewriteArtifact", **self._log_defaults)
+            return RewriteArtifact(nodes=nodes)
+
+        elif route == "replyToGeneralInput":
+            log(f"", next="RespondToQuery", **self._log_defaults)
+            return RespondToQuery(nodes=nodes)
 
-        if artifact:
-            artifact_snipet = prompts.ARTIFACT_SNIPPET.format(
-                artifact_content=str(artifact)
-            )
-            route_options_snippet = prompts.HAS_ARTIFACT_ROUTES
         else:
-            artifact_snipet = prompts.NO_ARTIFACT_SNIPPET
-            route_options_snippet = prompts.NO_ARTIFACT_ROUTES
+            log(
+                f"[orange]WARNING:[/] Indecisive output",
+                next="GenerateArtifact",
+                **self._log_defaults,
+            )
+            return GenerateArtifact(nodes=nodes)
 
+    async def _select_route(
+        self,
+        user_query: str,
+        artifact: Optional[str],
+        chat_history: List[Any],
+        app_context: str,
+    ) -> str:
         prompt = prompts.GENERATE_PATH_PROMPT.format(
             app_context=app_context,
-            artifact=artifact_snipet,
-            recent_messages=recent_messages_snippet,
-            route_options=route_options_snippet,
+            artifact=self._artifact_snippet(artifact),
+            recent_messages=self._recent_messages_snippet(chat_history),
+            route_options=(
+                prompts.HAS_ARTIFACT_ROUTES if artifact else prompts.NO_ARTIFACT_ROUTES
+            ),
             user_query=user_query,
         )
 
-        class _Route(str, Enum):
-            generateArtifact = "generateArtifact"
-            replyToGeneralInput = "replyToGeneralInput"
-            rewriteArtifact = "rewriteArtifact"
-
         class _RouteCompletion(BaseModel):
-            route: _Route
+            route: ArtifactRoute
 
         structured_llm = self.llm.as_structured_llm(output_cls=_RouteCompletion)
 
-        response = structured_llm.complete(prompt)
+        async with resources.limiter("gemini").slot():
+            response = await structured_llm.acomplete(prompt, **self.llm_kwargs)
 
         response_object: _RouteCompletion = _RouteCompletion.model_validate_json(
             json_data=response.text
@@ -495,27 +795,10 @@ class DesignExpertWorkflow(Workflow):
 
         log(response.text, **self._log_defaults)
 
-        if response_object.route == "generateArtifact":
-            log(f"", next="GenerateArtifact", **self._log_defaults)
-            return GenerateArtifact(nodes=ev.nodes)
-
-        elif response_object.route == "rewriteArtifact":
-            log(f"", next="RewriteArtifact", **self._log_defaults)
-            return RewriteArtifact(nodes=ev.nodes)
-
-        elif response_object.route == "replyToGeneralInput":
-            log(f"", next="RespondToQuery", **self._log_defaults)
-            return RespondToQuery(nodes=ev.nodes)
-
-        else:
-            log(
-                f"[orange]WARNING:[/] Indecisive output",
-                next="GenerateArtifact",
-                **self._log_defaults,
-            )
-            return GenerateArtifact(nodes=ev.nodes)
+        return response_object.route.value
 
     @step
+    @timed_step
     async def generate_artifact(self, ctx: Context, ev: GenerateArtifact) -> StopEvent:
         user_query = await ctx.get("original_user_message")
         app_context = prompts.APP_CONTEXT_SNIPPET
@@ -542,23 +825,28 @@ class DesignExpertWorkflow(Workflow):
 
         log(f"Generating new artifact", **self._log_defaults)
 
-        response_gen = self.llm.stream_complete(prompt=prompt)
+        # The gemini slot is held until the answer has been streamed
+        response_gen = await resources.limiter("gemini").stream(
+            self.llm.astream_complete(prompt=prompt, **self.llm_kwargs)
+        )
 
         return StopEvent(
             WorkflowResult(async_response_gen=response_gen, nodes=ev.nodes)
         )
 
     @step
+    @timed_step
     async def update_artifact(self, ctx: Context, ev: UpdateArtifact) -> StopEvent:
         user_query = await ctx.get("original_user_message")
         app_context = prompts.APP_CONTEXT_SNIPPET
         highlighted_text = await ctx.get("highlighted_text")
         artifact = await ctx.get("artifact")
+        artifact_id = await ctx.get("artifact_id")
 
         ctx.write_event_to_stream(
             ProgressEvent(
                 description=f"Updating artifact",
-                payload={"artifactId": artifact.id},
+                payload={"artifactId": artifact_id},
             )
         )
 
@@ -575,13 +863,17 @@ class DesignExpertWorkflow(Workflow):
         )
 
         log(f"Updating existing artifact", **self._log_defaults)
-        response_gen = self.llm.stream_complete(prompt=prompt)
+        # The gemini slot is held until the answer has been streamed
+        response_gen = await resources.limiter("gemini").stream(
+            self.llm.astream_complete(prompt=prompt, **self.llm_kwargs)
+        )
 
         return StopEvent(
             WorkflowResult(async_response_gen=response_gen, nodes=ev.nodes)
         )
 
     @step
+    @timed_step
     async def rewrite_artifact(self, ctx: Context, ev: RewriteArtifact) -> StopEvent:
         user_query = await ctx.get("original_user_message")
         app_context = prompts.APP_CONTEXT_SNIPPET
@@ -609,13 +901,17 @@ class DesignExpertWorkflow(Workflow):
 
         log(f"Generating new artifact", **self._log_defaults)
 
-        response_gen = self.llm.stream_complete(prompt=prompt)
+        # The gemini slot is held until the answer has been streamed
+        response_gen = await resources.limiter("gemini").stream(
+            self.llm.astream_complete(prompt=prompt, **self.llm_kwargs)
+        )
 
         return StopEvent(
             WorkflowResult(async_response_gen=response_gen, nodes=ev.nodes)
         )
 
     @step
+    @timed_step
     async def respond_to_query(self, ctx: Context, ev: RespondToQuery) -> StopEvent:
         app_context = prompts.APP_CONTEXT_SNIPPET
         user_query = await ctx.get("original_user_message")
@@ -633,24 +929,17 @@ class DesignExpertWorkflow(Workflow):
             retrieved_context=formatted_context_list
         )
 
-        if len(chat_history):
-            recent_messages_acc: str = ""
-            for message in last_n(chat_history, 3):
-                recent_messages_acc += str(message)
-            recent_messages_snippet = prompts.RECENT_MESSAGES_SNIPPET.format(
-                recent_mesages=recent_messages_acc
-            )
-        else:
-            recent_messages_snippet = prompts.NO_RECENT_MESSAGES
-
         prompt = prompts.RESPOND_TO_QUERY_PROMPT.format(
             app_context=app_context,
             user_query=user_query,
             retrieval_context_snippet=formatted_context_list,
-            recent_messages=recent_messages_snippet,
+            recent_messages=self._recent_messages_snippet(chat_history),
         )
 
-        response_gen = self.llm.stream_complete(prompt=prompt)
+        # The gemini slot is held until the answer has been streamed
+        response_gen = await resources.limiter("gemini").stream(
+            self.llm.astream_complete(prompt=prompt, **self.llm_kwargs)
+        )
 
         return StopEvent(
             WorkflowResult(async_response_gen=response_gen, nodes=ev.nodes)
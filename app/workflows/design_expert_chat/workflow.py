@@ -15,26 +15,28 @@ from llama_index.core.workflow import (
     Context,
 )
 from llama_index.core.postprocessor import SimilarityPostprocessor, LongContextReorder
-from llama_index.postprocessor.colbert_rerank import ColbertRerank
 from llama_index.core.llms import ChatMessage, LLM
 from llama_index.core.postprocessor import LongContextReorder
 from llama_index.core.base.llms.types import MessageRole
-from llama_index.core.schema import NodeWithScore
-from llama_index.tools.duckduckgo import DuckDuckGoSearchToolSpec
+from llama_index.core.schema import NodeWithScore, QueryBundle
 from llama_index.core.embeddings.utils import EmbedType
 from llama_index.core import Settings
 from llama_index.core import VectorStoreIndex
-from langfuse.llama_index import LlamaIndexInstrumentor
-import datetime
 import json_repair.json_parser
 import re
-import inspect
 from pydantic import BaseModel, Field
 from typing import Literal
 
-from typing import List, Any
+from typing import Dict, List, Any, Optional
 
+from libs.context_packer import pack_nodes
 from libs.crawl4ai import Crawl4AiReader, string_metadata_dict
+from libs.ephemeral_index import EphemeralVectorRetriever
+from libs.node_dedup import DeduplicateNodesPostprocessor
+from libs.reranker import RerankerService
+from libs.resources import resources
+from libs.router import QueryRouter, RouterDecision
+from libs.workflow_log import record_nodes, timed_step, workflow_logger
 
 
 class RankKnowledge(Event):
@@ -64,16 +66,24 @@ class TaskEvent(Event):
 
 class ProgressEvent(Event):
     description: str
+    payload: Dict[str, Any] | None = None
 
 
 class DesignRAGWorkflow(Workflow):
 
     llm: LLM
+    llm_kwargs: Dict[str, Any]
     embedding: EmbedType
     document_index: VectorStoreIndex
+    router: Optional[QueryRouter]
+    reranker: Optional[RerankerService]
+    rerank_kwargs: Dict[str, Any]
+    context_kwargs: Dict[str, Any]
 
     DOCUMENTS_PER_SEARCH = 5
     SEARCH_RESULTS_TOP_K = 10
+    # Pages not crawled within this many seconds are dropped from the search results
+    CRAWL_TIMEOUT = 20
 
     RETRIEVE_TOP_K = 20
 
@@ -91,25 +101,34 @@ class DesignRAGWorkflow(Workflow):
         llm: LLM,
         embedding: EmbedType,
         document_index: VectorStoreIndex,
+        llm_kwargs: Optional[Dict[str, Any]] = None,
+        router: Optional[QueryRouter] = None,
+        reranker: Optional[RerankerService] = None,
+        rerank_kwargs: Optional[Dict[str, Any]] = None,
+        context_kwargs: Optional[Dict[str, Any]] = None,
         **kwargs: Any,
     ):
         super().__init__(**kwargs)
         self.llm = llm
+        self.llm_kwargs = llm_kwargs or {}
         self.embedding = embedding
         self.document_index = document_index
+        self.router = router
+        self.reranker = reranker
+        self.rerank_kwargs = rerank_kwargs or {}
+        self.context_kwargs = context_kwargs or {}
         pass
 
     def _log(self, user: str, content: str, truncate: bool = True) -> None:
         TRUNCATE_LEN = 56
-        step_name = inspect.stack()[1][3]
-        timestamp = datetime.datetime.now().strftime("%H:%M:%S·%d.%m.%y")
 
         _content = content
         if truncate and len(content) > TRUNCATE_LEN:
             _content = content[:TRUNCATE_LEN] + " <...>"
 
-        log_str = f"\n>>> {timestamp} {user}\n" f"[{step_name}] {_content}"
-        print(log_str)
+        workflow_logger.log(
+            _content, stacklevel=2, workflow=type(self).__name__, user=user
+        )
 
     def _update_system_message(
         self, messages: List[ChatMessage], system_message: str
@@ -159,7 +178,17 @@ class DesignRAGWorkflow(Workflow):
     def _cleanup_json(self, content: str) -> Any:
         return json_repair.loads(content)
 
+    async def _user_query_embedding(self, ctx: Context) -> List[float]:
+        """Query embedding of the user message, computed once per run"""
+        embedding = await ctx.get("original_user_query_embedding", None)
+        if embedding is None:
+            user_query = await ctx.get("original_user_query")
+            embedding = await self.embedding.aget_query_embedding(str(user_query))
+            await ctx.set("original_user_query_embedding", embedding)
+        return embedding
+
     @step
+    @timed_step
     async def prepare(
         self, ctx: Context, ev: StartEvent
     ) -> RankKnowledge | SearchEvent | TaskEvent:
@@ -186,6 +215,7 @@ class DesignRAGWorkflow(Workflow):
             raise Exception("Empty user message")
 
         await ctx.set("original_user_query", user_query)
+        await ctx.set("original_user_query_embedding", None)
 
         """ Determine if the query needs RAG """
         task_differentiation_prompt = (
@@ -217,18 +247,51 @@ class DesignRAGWorkflow(Workflow):
             "\n"
             "Answer:\n"
         )
-        task_differentiation_chat = self._update_last_user_message(
-            content=task_differentiation_prompt, messages=chat_history
-        )
-        verdict_response = self.llm.chat(messages=task_differentiation_chat)
-        if verdict_response.message.content is None:
-            raise Exception(
-                "Step [prepare]: returned invalid response. Cannot reason about task type"
+        decision: Optional[RouterDecision] = None
+        if self.router is not None and self.router.enabled:
+            try:
+                decision = await self.router.classify(
+                    str(user_query), embedding=await self._user_query_embedding(ctx)
+                )
+            except Exception as error:
+                self._log(user, f"local router failed, asking LLM: {str(error)}", False)
+
+        if decision is not None and decision.confident:
+            verdict = decision.label
+        else:
+            task_differentiation_chat = self._update_last_user_message(
+                content=task_differentiation_prompt, messages=chat_history
             )
+            async with resources.limiter("gemini").slot():
+                verdict_response = await self.llm.achat(
+                    messages=task_differentiation_chat, **self.llm_kwargs
+                )
+            if verdict_response.message.content is None:
+                raise Exception(
+                    "Step [prepare]: returned invalid response. Cannot reason about task type"
+                )
+
+            # verdict_obj = self._cleanup_json(verdict.message.content)
+            verdict = str(verdict_response.message.content).strip()
+            if self.router is not None:
+                self.router.record(
+                    str(user_query),
+                    verdict,
+                    embedding=decision.embedding if decision is not None else None,
+                )
+            decision = RouterDecision(label=verdict, confidence=1.0, source="llm")
 
-        # verdict_obj = self._cleanup_json(verdict.message.content)
-        verdict = str(verdict_response.message.content).strip()
-        self._log(user, f"task classification = {verdict}", False)
+        self._log(
+            user,
+            f"task classification = {verdict} ({decision.source}, confidence={decision.confidence:.2f})",
+            False,
+        )
+        ctx.write_event_to_stream(
+            ProgressEvent(
+                description=f"Task classification: {verdict}",
+                payload={"router": decision.as_payload()},
+            )
+        )
 
         if verdict == "QUERY":
             ctx.send_event(SearchEvent(query=user_query))
@@ -240,6 +303,7 @@ class DesignRAGWorkflow(Workflow):
         return None  # type: ignore[func-returns-value]
 
     @step
+    @timed_step
     async def retrieve_documents(
         self, ctx: Context, ev: RankKnowledge
     ) -> CollectRankedNodes:
@@ -254,7 +318,12 @@ class DesignRAGWorkflow(Workflow):
             retriever = self.document_index.as_retriever(
                 similarity_top_k=self.RETRIEVE_TOP_K
             )
-            nodes: List[NodeWithScore] = retriever.retrieve(query)
+            # Embedded before taking the qdrant slot, which then only covers the search
+            embedding = await self.embedding.aget_query_embedding(query)
+            async with resources.limiter("qdrant").slot():
+                nodes: List[NodeWithScore] = await retriever.aretrieve(
+                    QueryBundle(query_str=query, embedding=embedding)
+                )
             self._log(_user, f"returned {len(nodes)} nodes")
             return CollectRankedNodes(nodes=nodes)
 
@@ -263,6 +332,7 @@ class DesignRAGWorkflow(Workflow):
             return CollectRankedNodes(nodes=[])
 
     @step
+    @timed_step
     async def generate_search_queries(
         self, ctx: Context, ev: SearchEvent
     ) -> RankSearchResults | RankKnowledge:
@@ -297,7 +367,8 @@ class DesignRAGWorkflow(Workflow):
             content=content.format(query=query), messages=chat_history
         )
 
-        result = self.llm.chat(messages=chat_history)
+        async with resources.limiter("gemini").slot():
+            result = await self.llm.achat(messages=chat_history, **self.llm_kwargs)
         if result.message.content is None:
             raise Exception(
                 "Step [generate_search_queries]: returned invalid response None"
@@ -325,6 +396,7 @@ class DesignRAGWorkflow(Workflow):
         return None  # type: ignore[func-returns-value]
 
     @step
+    @timed_step
     async def query_search_results(
         self, ctx: Context, ev: RankSearchResults
     ) -> CollectRankedNodes:
@@ -332,22 +404,27 @@ class DesignRAGWorkflow(Workflow):
         search_query: str = ev.search_query
         self._log(_user, f"started for '{search_query}'")
         try:
-            search_results = DuckDuckGoSearchToolSpec().duckduckgo_full_search(
+            search_results = await resources.web_search().search(
                 query=search_query, max_results=self.DOCUMENTS_PER_SEARCH
             )
-            crawl_reader = Crawl4AiReader()
-            documents = await crawl_reader.read_markdown_documents(
-                urls=[source["href"] for source in search_results]
-            )
+            crawl_reader = resources.crawl_reader()
+            documents = [
+                document
+                async for document in crawl_reader.stream_markdown_documents(
+                    urls=[source["href"] for source in search_results],
+                    timeout=self.CRAWL_TIMEOUT,
+                )
+            ]
             self._log(_user, f"crawled {len(documents)} documents")
-            index = VectorStoreIndex.from_documents(
-                documents, show_progress=False, embed_model=self.embedding
-            )
-            retriever = index.as_retriever(
-                verbose=False, similarity_top_k=self.SEARCH_RESULTS_TOP_K
+            retriever = await EphemeralVectorRetriever.afrom_documents(
+                documents,
+                embed_model=self.embedding,
+                similarity_top_k=self.SEARCH_RESULTS_TOP_K,
             )
             user_query = await ctx.get("original_user_query")
-            output: List[NodeWithScore] = retriever.retrieve(user_query)
+            output: List[NodeWithScore] = await retriever.aretrieve(
+                user_query, query_embedding=await self._user_query_embedding(ctx)
+            )
             self._log(_user, f"dispatched {len(output)} nodes")
             return CollectRankedNodes(nodes=output)
 
@@ -358,6 +435,7 @@ class DesignRAGWorkflow(Workflow):
             return CollectRankedNodes(nodes=[])
 
     @step
+    @timed_step
     async def process_nodes(
         self, ctx: Context, ev: CollectRankedNodes
     ) -> SynthesizeEvent:
@@ -380,25 +458,33 @@ class DesignRAGWorkflow(Workflow):
         for event in event_results:
             all_nodes += event.nodes or []
 
-        colbert_reranker = ColbertRerank(
-            model="colbert-ir/colbertv2.0",
-            tokenizer="colbert-ir/colbertv2.0",
-            keep_retrieval_score=True,
-            device="gpu",
-        )
-
         user_query = await ctx.get("original_user_query")
 
-        # self._log(_user, f"reranking started")
-        # reranked_nodes = colbert_reranker.postprocess_nodes(nodes=all_nodes, query_str=user_query)
-        # self._log(_user, f"reranking ended")
-
         self._log(_user, f"postprocessing started")
+        dedup_postprocessor = DeduplicateNodesPostprocessor()
+        nodes_unique = dedup_postprocessor.postprocess_nodes(all_nodes)
+        self._log(_user, f"removed {len(all_nodes) - len(nodes_unique)} duplicate nodes")
+        record_nodes(type(self).__name__, "retrieved", len(all_nodes))
+        record_nodes(type(self).__name__, "deduplicated", len(nodes_unique))
+
         similarity_cutoff_postprocessor = SimilarityPostprocessor(
             similarity_cutoff=self.POSTPROCESSING_SIMILARITY_CUTOFF
         )
         long_context_reorder_postprocessor = LongContextReorder()
-        nodes_cutoff = similarity_cutoff_postprocessor.postprocess_nodes(all_nodes)
+        nodes_cutoff = similarity_cutoff_postprocessor.postprocess_nodes(nodes_unique)
+
+        if self.reranker is not None:
+            self._log(_user, f"reranking started")
+            nodes_cutoff = await self.reranker.rerank(
+                str(user_query), nodes_cutoff, **self.rerank_kwargs
+            )
+            self._log(_user, f"reranking ended: {len(nodes_cutoff)} nodes")
+        record_nodes(type(self).__name__, "filtered", len(nodes_cutoff))
+
+        if self.context_kwargs:
+            packed_context = pack_nodes(nodes_cutoff, **self.context_kwargs)
+            nodes_cutoff = packed_context.nodes
+            self._log(_user, f"context packed: {packed_context.report()}")
         nodes_reordered = long_context_reorder_postprocessor.postprocess_nodes(
             nodes_cutoff
         )
@@ -406,6 +492,7 @@ class DesignRAGWorkflow(Workflow):
             _user,
             f"postprocessing ended: {len(nodes_reordered)}/{len(all_nodes)} returned",
         )
+        record_nodes(type(self).__name__, "packed", len(nodes_reordered))
 
         return SynthesizeEvent(nodes=nodes_reordered, query=user_query)
 
@@ -431,6 +518,7 @@ class DesignRAGWorkflow(Workflow):
         return result
 
     @step
+    @timed_step
     async def produce_result(self, ctx: Context, ev: SynthesizeEvent) -> StopEvent:
         _user = await ctx.get("user")
         self._log(_user, f"query path response synthesize started")
@@ -466,7 +554,10 @@ class DesignRAGWorkflow(Workflow):
             content=message_with_context, messages=chat_history
         )
 
-        response = self.llm.stream_chat(chat_history)
+        # The gemini slot is held until the answer has been streamed
+        response = await resources.limiter("gemini").stream(
+            self.llm.astream_chat(chat_history, **self.llm_kwargs)
+        )
 
         result = {
             "message": response,
@@ -479,6 +570,7 @@ class DesignRAGWorkflow(Workflow):
         return StopEvent(result=result)
 
     @step
+    @timed_step
     async def execute_task(self, ctx: Context, ev: TaskEvent) -> StopEvent:
         _user = await ctx.get("user")
 
@@ -487,6 +579,8 @@ class DesignRAGWorkflow(Workflow):
         query_chat = self._update_last_user_message(
             content=ev.query, messages=chat_history
         )
-        response = self.llm.stream_chat(query_chat)
+        response = await resources.limiter("gemini").stream(
+            self.llm.astream_chat(query_chat, **self.llm_kwargs)
+        )
         result = {"message": response}
         return StopEvent(result=result)